@@ -0,0 +1,91 @@
+"""Allocation check of the i2cdevice transfer path against a simulated LTR559.
+
+Register reads, writes and burst reads go through each Device's preallocated
+transfer buffer, so once warmed up they shouldn't allocate anything, not even
+short lived objects that are freed straight away and left for the collector.
+This runs them many times under tracemalloc, resetting the peak first, and
+fails if the peak traced memory rises further than it does for the same number
+of bare bus transactions on a preallocated buffer. The simulated register
+peripherals read and write the caller's buffer in place, so the bus itself
+doesn't allocate beyond its own loop overhead.
+
+Some slack is allowed for what CPython allocates and CircuitPython doesn't,
+range objects for `for x in range(...)` loops and boxed register values too big
+for its cached small ints. A transfer buffer, list or memoryview slice per
+transfer is over it. Small lists and tuples come from CPython's free lists
+and aren't traced at all, so this can't see those.
+
+Run on a host from the repository root:
+
+    python benchmarks/i2cdevice_alloc.py
+"""
+import os
+import sys
+import tracemalloc
+from itertools import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from i2cdevice.simulator import SimulatedI2C, LTR559Peripheral  # noqa: E402
+from ltr559 import LTR559  # noqa: E402
+
+ITERATIONS = 50
+
+# Bytes of peak traced memory allowed for host only allocations, see above. The transfers
+# peak 48 bytes over the bare transactions on CPython 3.11 and one extra transfer sized
+# bytearray takes them to 65.
+SLACK = 56
+
+
+def transfers(device, block):
+    device.read_register('ALS_PS_STATUS')
+    device.read_register('ALS_DATA')
+    device.write_register('PS_LED')
+    device.write_register('ALS_THRESHOLD')
+    block.read()
+
+
+def bare(device, block):
+    bus = device._i2c
+    buffer = device._buffer
+    for _ in repeat(None, 5):
+        bus.writeto_then_readfrom(device._i2c_address, buffer, buffer, out_end=1, in_start=1, in_end=2)
+
+
+def peak(function, device, block):
+    """Return how far the traced memory peaks above its starting point while calling function.
+    repeat() is used to loop so the loop counter isn't a boxed int itself, and the counters
+    are reset so they stay within CPython's cached small ints.
+    """
+    device._i2c.reset_stats()
+    device.cache_hits = 0
+    device.cache_misses = 0
+    start, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for _ in repeat(None, ITERATIONS):
+        function(device, block)
+    return tracemalloc.get_traced_memory()[1] - start
+
+
+def main():
+    bus = SimulatedI2C()
+    bus.attach(LTR559Peripheral()).set_light(1200, 600)
+    device = LTR559(i2c_dev=bus)._ltr559
+    block = device.block('ALS_DATA', 'ALS_PS_STATUS', 'PS_DATA')
+
+    tracemalloc.start()
+    # Warm up so one-off allocations, such as interpreter caches, aren't counted
+    peak(bare, device, block)
+    peak(transfers, device, block)
+    overhead = peak(bare, device, block)
+    used = peak(transfers, device, block) - overhead
+    tracemalloc.stop()
+
+    print("{} transactions, peak {} bytes over bare bus transactions, {} allowed".format(
+        bus.transactions, used, SLACK))
+    if used > SLACK:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
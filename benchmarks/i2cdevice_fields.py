@@ -0,0 +1,99 @@
+"""Micro-benchmark of i2cdevice field access against a simulated LTR559.
+
+Times get_field/set_field through the precompiled field codecs and through a
+reference copy of the previous implementation, which worked out the shift with
+_trailing_zeros and walked the adapter lookup table on every access. Registers
+are locked while timing so only the field decode/encode is measured, not the bus.
+
+Run on a host from the repository root:
+
+    python benchmarks/i2cdevice_fields.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from i2cdevice import _trailing_zeros  # noqa: E402
+from i2cdevice.adapter import LookupAdapter  # noqa: E402
+from i2cdevice.simulator import SimulatedI2C, LTR559Peripheral  # noqa: E402
+from ltr559 import LTR559  # noqa: E402
+
+ITERATIONS = 20000
+
+
+def reference_get_field(device, register, field):
+    register = device.registers[register]
+    field = register.fields[field]
+    value = (device.values[register.name] & field.mask) >> _trailing_zeros(field.mask, register.bit_width)
+    if isinstance(field.adapter, LookupAdapter):
+        for k, v in field.adapter.lookup_table.items():
+            if v == value:
+                return k
+        raise ValueError("{} not in lookup table".format(value))
+    if field.adapter is not None:
+        value = field.adapter._decode(value)
+    return value
+
+
+def reference_set_field(device, register, field, value):
+    register = device.registers[register]
+    field = register.fields[field]
+    shift = _trailing_zeros(field.mask, register.bit_width)
+    if isinstance(field.adapter, LookupAdapter):
+        table = field.adapter.lookup_table
+        value = table[min(list(table.keys()), key=lambda x: abs(x - value))]
+    elif field.adapter is not None:
+        value = field.adapter._encode(value)
+    reg_value = device.values[register.name] & ~field.mask
+    device.values[register.name] = reg_value | ((value << shift) & field.mask)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        function(*args)
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+
+def main():
+    bus = SimulatedI2C()
+    peripheral = bus.attach(LTR559Peripheral())
+    sensor = LTR559(i2c_dev=bus)
+    peripheral.set_light(1200, 600)
+    device = sensor._ltr559
+
+    cases = (
+        ('get', 'ALS_PS_STATUS', 'als_data', None),
+        ('get', 'ALS_PS_STATUS', 'als_gain', None),
+        ('get', 'ALS_DATA', 'ch0', None),
+        ('set', 'ALS_CONTROL', 'gain', 48),
+        ('set', 'PS_CONTROL', 'active', True),
+    )
+
+    print("{:<6}{:<28}{:>12}{:>12}{:>9}".format("op", "field", "before us", "after us", "speedup"))
+    for op, register, field, value in cases:
+        device.read_register(register)
+        device.lock_register(register)
+        if op == 'get':
+            before = timed(reference_get_field, device, register, field)
+            after = timed(device.get_field, register, field)
+        else:
+            before = timed(reference_set_field, device, register, field, value)
+            after = timed(device.set_field, register, field, value)
+        device.unlock_register(register)
+        print("{:<6}{:<28}{:>12.2f}{:>12.2f}{:>8.1f}x".format(
+            op, register + '.' + field, before, after, before / after))
+
+    bus.reset_stats()
+    start = time.perf_counter()
+    for _ in range(ITERATIONS // 10):
+        sensor.update_sensor()
+    elapsed = (time.perf_counter() - start) / (ITERATIONS // 10) * 1e6
+    print("update_sensor: {:.1f} us, {:.1f} transactions per sample".format(
+        elapsed, bus.transactions / (ITERATIONS // 10)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Run the Sensors pipeline on a host against simulated hardware.
+
+Attaches LTR559, BME280 and SGP30 personalities to a SimulatedI2C bus, with a
+simulated battery monitor, and drives `Sensors.run` for a few seconds. Prints
+each update, then the bus traffic and the CPU time per update.
+
+Needs the Adafruit drivers Sensors uses, which run on CPython:
+
+    pip3 install adafruit-circuitpython-bme280 adafruit-circuitpython-sgp30 adafruit-circuitpython-logging
+
+Run on a host from the repository root:
+
+    python benchmarks/sensors_simulated.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+sys.path.insert(0, ROOT)
+
+from i2cdevice.simulator import (  # noqa: E402
+    SimulatedI2C, AnalogInput, LTR559Peripheral, BME280Peripheral, SGP30Peripheral)
+from sensors import Sensors  # noqa: E402
+
+DURATION = 3.0
+UPDATE_TIMEOUT = 0.5
+
+
+def main():
+    # 100kHz I2C, roughly 11000 bytes per second plus a little per transaction
+    bus = SimulatedI2C(latency=0.0001, byte_rate=11000)
+    light = bus.attach(LTR559Peripheral())
+    bus.attach(BME280Peripheral())
+    air = bus.attach(SGP30Peripheral())
+    battery = AnalogInput(voltage=1.9)
+
+    sensors = Sensors(update_timeout=UPDATE_TIMEOUT, i2c=bus, battery=battery,
+                      sample_periods={'sgp30': 0.25, 'battery': 1.0})
+    updates = []
+
+    @sensors.on_update
+    def on_update(readings):
+        updates.append(readings.sequence)
+        print("{:3d} {:6.2f}C {:6.2f}% {:7.2f}hPa {:5d}ppm {:4d}ppb {:8.2f}lux {:5d}mV".format(
+            readings.sequence, readings.temperature, readings.humidity, readings.pressure,
+            readings.eco2, readings.tvoc, readings.light, readings.battery_voltage))
+
+    bus.reset_stats()
+    cpu = time.process_time()
+    start = time.monotonic()
+    while time.monotonic() - start < DURATION:
+        # Give the simulated sensors something to report
+        light.set_light(1000 + len(updates) * 50, 400)
+        air.eco2 = 400 + len(updates) * 10
+        sensors.run()
+    cpu = time.process_time() - cpu
+
+    print("{} updates, {} transactions, {} bytes, {:.1f}ms simulated bus time".format(
+        len(updates), bus.transactions, bus.bytes_transferred, bus.elapsed * 1000))
+    if updates:
+        print("{:.2f}ms CPU per update, including the idle loop between them".format(
+            cpu / len(updates) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -95,5 +95,8 @@ class Display():
         self.display_group.append(self.label_humidity)
 
     def update(self, readings):
+        # Nothing to redraw unless a shown reading moved outside its deadband
+        if not readings.changed & readings.mask('temperature', 'humidity'):
+            return
         self.label_temperature.text = str(int(readings.temperature)) +'°C'
         self.label_humidity.text = str(int(readings.humidity)) + '%'
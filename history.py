@@ -0,0 +1,428 @@
+import time
+import struct
+from array import array
+
+# Stored for channels with no new sample at an update, skipped by queries
+_NAN = float('nan')
+
+
+class History:
+    """Fixed memory history of a set of channels, such as SensorData.FIELDS.
+    Each channel is a ring of `size` floats and the sample times are kept once, as whole
+    seconds of time.monotonic(), in a shared ring. Appending is O(1) and never allocates,
+    queries walk back from the newest sample so they only touch the window asked for.
+    Channels without a new sample at an update hold NaN there, which queries skip, so a
+    missing sensor has no history and a slow one isn't counted once per update.
+    Channels are given by index or by name.
+    """
+    def __init__(self, fields, size=120):
+        self.fields = fields
+        self.size = size
+        self.channels = [array('f', [0.0] * size) for _ in fields]
+        # Signed, times restored after a deep sleep are before the new time.monotonic() zero
+        self.timestamps = array('l', [0] * size)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _channel(self, channel):
+        if type(channel) is str:
+            channel = self.fields.index(channel)
+        return self.channels[channel]
+
+    def append(self, readings, timestamp=None):
+        """Store the fields of a SensorData refreshed since its previous update.
+        :param timestamp: Time of the sample in seconds, time.monotonic() if not given
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        head = self._head
+        values = readings.values
+        refreshed = readings.refreshed
+        for x in range(len(self.channels)):
+            self.channels[x][head] = values[x] if refreshed & (1 << x) else _NAN
+        self._advance(timestamp)
+
+    def _advance(self, timestamp):
+        self.timestamps[self._head] = int(timestamp)
+        self._head = (self._head + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def latest(self, channel):
+        """Return the newest value of a channel, or None if it has no samples."""
+        values = self._channel(channel)
+        index = self._head
+        for _ in range(self._count):
+            index = (index - 1) % self.size
+            value = values[index]
+            if value == value:
+                return value
+        return None
+
+    def window(self, channel, seconds, now=None):
+        """Yield (timestamp, value) pairs from the last `seconds` seconds, newest first.
+        Updates where the channel had no new sample are skipped.
+        :param now: Time to measure the window back from, time.monotonic() if not given
+        """
+        if now is None:
+            now = time.monotonic()
+        values = self._channel(channel)
+        start = now - seconds
+        index = self._head
+        for _ in range(self._count):
+            index = (index - 1) % self.size
+            timestamp = self.timestamps[index]
+            if timestamp < start:
+                return
+            value = values[index]
+            if value == value:
+                yield timestamp, value
+
+    def stats(self, channel, seconds, now=None):
+        """Return (minimum, maximum, mean, count) over the last `seconds` seconds.
+        Minimum, maximum and mean are None if there are no samples in the window.
+        """
+        low = None
+        high = None
+        total = 0.0
+        count = 0
+        for _, value in self.window(channel, seconds, now):
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+            total += value
+            count += 1
+        if count == 0:
+            return None, None, None, 0
+        return low, high, total / count, count
+
+    def save(self, memory, offset, base_time, size=None):
+        """Save the newest samples that fit to memory, such as alarm.sleep_memory.
+        Times are stored relative to base_time, see `restore`. Returns the number of bytes used.
+        :param memory: Writable buffer
+        :param offset: Index within memory to save at
+        :param base_time: Time the saved timestamps are relative to
+        :param size: Bytes available from offset, the rest of memory if None
+        """
+        if size is None:
+            size = len(memory) - offset
+        if size < 2:
+            return 0
+        sample_format = "<l" + "f" * len(self.channels)
+        sample_size = struct.calcsize(sample_format)
+        count = min(self._count, (size - 2) // sample_size)
+        memory[offset:offset + 2] = struct.pack("<H", count)
+        position = offset + 2
+        index = (self._head - count) % self.size
+        for _ in range(count):
+            data = struct.pack(sample_format, self.timestamps[index] - int(base_time),
+                               *[channel[index] for channel in self.channels])
+            memory[position:position + sample_size] = data
+            position += sample_size
+            index = (index + 1) % self.size
+        return position - offset
+
+    def restore(self, memory, offset, base_time):
+        """Append the samples saved with `save`, with times relative to base_time.
+        Returns the number of bytes read.
+        """
+        if len(memory) - offset < 2:
+            return 0
+        sample_format = "<l" + "f" * len(self.channels)
+        sample_size = struct.calcsize(sample_format)
+        count = struct.unpack("<H", bytes(memory[offset:offset + 2]))[0]
+        count = min(count, (len(memory) - offset - 2) // sample_size)
+        position = offset + 2
+        for _ in range(count):
+            sample = struct.unpack(sample_format, bytes(memory[position:position + sample_size]))
+            for x in range(len(self.channels)):
+                self.channels[x][self._head] = sample[x + 1]
+            self._advance(int(base_time) + sample[0])
+            position += sample_size
+        return position - offset
+
+    def minimum(self, channel, seconds, now=None):
+        return self.stats(channel, seconds, now)[0]
+
+    def maximum(self, channel, seconds, now=None):
+        return self.stats(channel, seconds, now)[1]
+
+    def mean(self, channel, seconds, now=None):
+        return self.stats(channel, seconds, now)[2]
+
+
+class _Level:
+    """One resolution of a Downsampler, a ring of closed buckets plus the bucket being filled."""
+    def __init__(self, channels, interval, size):
+        self.interval = interval
+        self.size = size
+        self.starts = array('L', [0] * size)
+        self.mins = [array('f', [0.0] * size) for _ in range(channels)]
+        self.maxs = [array('f', [0.0] * size) for _ in range(channels)]
+        self.sums = [array('f', [0.0] * size) for _ in range(channels)]
+        self.counts = [array('L', [0] * size) for _ in range(channels)]
+        self.head = 0
+        self.length = 0
+
+        self.bucket = None
+        self.open_min = array('f', [0.0] * channels)
+        self.open_max = array('f', [0.0] * channels)
+        self.open_sum = array('f', [0.0] * channels)
+        self.open_count = array('L', [0] * channels)
+
+    def merge(self, channel, low, high, total, count):
+        if count == 0:
+            return
+        if self.open_count[channel] == 0:
+            self.open_min[channel] = low
+            self.open_max[channel] = high
+        else:
+            self.open_min[channel] = min(self.open_min[channel], low)
+            self.open_max[channel] = max(self.open_max[channel], high)
+        self.open_sum[channel] += total
+        self.open_count[channel] += count
+
+    def close(self):
+        """Move the open bucket into the ring and start an empty one."""
+        head = self.head
+        self.starts[head] = self.bucket * self.interval
+        for channel in range(len(self.open_count)):
+            self.mins[channel][head] = self.open_min[channel]
+            self.maxs[channel][head] = self.open_max[channel]
+            self.sums[channel][head] = self.open_sum[channel]
+            self.counts[channel][head] = self.open_count[channel]
+            self.open_sum[channel] = 0.0
+            self.open_count[channel] = 0
+        self.head = (head + 1) % self.size
+        if self.length < self.size:
+            self.length += 1
+        return head
+
+
+class Downsampler:
+    """Multi-resolution aggregates of a set of channels, such as SensorData.FIELDS.
+    Samples are rolled into buckets of the first level, by default one per minute for an hour,
+    and each closed bucket is rolled into the next level, by default one per hour for two days.
+    Each bucket keeps the minimum, maximum, sum and count per channel in preallocated arrays,
+    so memory is fixed however long the node runs. Queries pick the finest level that still
+    covers the time range asked for. Use `save` and `restore` to keep the buckets across a
+    deep sleep.
+    :param fields: Names of all channels in order
+    :param levels: Sequence of (bucket seconds, bucket count) from finest to coarsest, each
+        interval must be a whole multiple of the one before
+    """
+    def __init__(self, fields, levels=((60, 60), (3600, 48))):
+        self.fields = fields
+        self.levels = [_Level(len(fields), interval, size) for interval, size in levels]
+        # Added to every time, so buckets restored after a deep sleep keep their bucket numbers
+        self._offset = 0
+
+    def _channel(self, channel):
+        if type(channel) is str:
+            return self.fields.index(channel)
+        return channel
+
+    def add(self, readings, timestamp):
+        """Add the fields of a SensorData refreshed since its previous update."""
+        level = self.levels[0]
+        bucket = int((timestamp + self._offset) // level.interval)
+        if bucket != level.bucket:
+            self._roll(0, bucket)
+        for channel in range(len(self.fields)):
+            if readings.refreshed & (1 << channel):
+                value = readings.values[channel]
+                level.merge(channel, value, value, value, 1)
+
+    def _roll(self, index, bucket):
+        """Close the open bucket of a level, passing it up to the next, and start bucket."""
+        level = self.levels[index]
+        if level.bucket is not None:
+            slot = level.close()
+            if index + 1 < len(self.levels):
+                parent = self.levels[index + 1]
+                parent_bucket = level.bucket * level.interval // parent.interval
+                if parent_bucket != parent.bucket:
+                    self._roll(index + 1, parent_bucket)
+                for channel in range(len(self.fields)):
+                    parent.merge(channel, level.mins[channel][slot], level.maxs[channel][slot],
+                                 level.sums[channel][slot], level.counts[channel][slot])
+        level.bucket = bucket
+
+    def level_for(self, seconds):
+        """Return the index of the finest level that holds at least `seconds` of history."""
+        for index, level in enumerate(self.levels):
+            if level.interval * level.size >= seconds:
+                return index
+        return len(self.levels) - 1
+
+    def buckets(self, channel, seconds, now):
+        """Yield (start time, minimum, maximum, mean, count) for buckets in the last `seconds`
+        seconds, oldest first, at the finest level covering the range. Empty buckets are skipped.
+        The bucket still being filled comes last, it includes any samples not yet rolled up
+        from finer levels.
+        """
+        channel = self._channel(channel)
+        index = self.level_for(seconds)
+        level = self.levels[index]
+        offset = self._offset
+        start = now + offset - seconds
+
+        slot = (level.head - level.length) % level.size
+        for _ in range(level.length):
+            count = level.counts[channel][slot]
+            if count and level.starts[slot] + level.interval > start:
+                yield (level.starts[slot] - offset, level.mins[channel][slot], level.maxs[channel][slot],
+                       level.sums[channel][slot] / count, count)
+            slot = (slot + 1) % level.size
+
+        low, high, total, count = self._open(channel, index)
+        if count:
+            # Until a coarser level has had a bucket rolled into it, the open data started in
+            # the open bucket of a finer level, such as in the first minute after waking
+            for open_level in self.levels[index::-1]:
+                if open_level.bucket is not None:
+                    yield open_level.bucket * open_level.interval - offset, low, high, total / count, count
+                    break
+
+    def save(self, memory, offset, base_time, size=None):
+        """Save as many buckets as fit to memory, such as alarm.sleep_memory.
+        Levels are saved coarsest first, each with its open bucket and as many of its newest
+        closed buckets as fit, so a short memory loses detail before it loses the long term.
+        Returns the number of bytes used, see `restore`.
+        :param memory: Writable buffer
+        :param offset: Index within memory to save at
+        :param base_time: Time at which the board is due to wake, see `restore`
+        :param size: Bytes available from offset, the rest of memory if None
+        """
+        if size is None:
+            size = len(memory) - offset
+        if size < 1:
+            return 0
+        channels = len(self.fields)
+        level_format = "<BBlH{0}f{0}f{0}f{0}L".format(channels)
+        slot_format = "<L{0}f{0}f{0}f{0}L".format(channels)
+        level_size = struct.calcsize(level_format)
+        slot_size = struct.calcsize(slot_format)
+        end = offset + size
+        # Number of levels saved, then the wake time on the bucket time line
+        header_size = struct.calcsize("<Bl")
+        position = offset + header_size
+        if position > end:
+            memory[offset:offset + 1] = bytes(1)
+            return 1
+        saved = 0
+        for index in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[index]
+            if position + level_size > end:
+                break
+            count = min(level.length, (end - position - level_size) // slot_size)
+            values = [index, level.bucket is not None, level.bucket if level.bucket is not None else 0, count]
+            values.extend(level.open_min)
+            values.extend(level.open_max)
+            values.extend(level.open_sum)
+            values.extend(level.open_count)
+            memory[position:position + level_size] = struct.pack(level_format, *values)
+            position += level_size
+            slot = (level.head - count) % level.size
+            for _ in range(count):
+                values = [level.starts[slot]]
+                for arrays in (level.mins, level.maxs, level.sums, level.counts):
+                    for channel in range(channels):
+                        values.append(arrays[channel][slot])
+                memory[position:position + slot_size] = struct.pack(slot_format, *values)
+                position += slot_size
+                slot = (slot + 1) % level.size
+            saved += 1
+        memory[offset:offset + header_size] = struct.pack("<Bl", saved, int(base_time) + self._offset)
+        return position - offset
+
+    def restore(self, memory, offset, base_time):
+        """Restore the buckets saved with `save`, replacing any held.
+        Bucket times carry on from the base_time given to `save`. Returns the number of bytes read.
+        :param base_time: Current time, taken as the wake time given to `save`
+        """
+        if len(memory) - offset < 1:
+            return 0
+        saved = memory[offset]
+        if saved == 0:
+            return 1
+        channels = len(self.fields)
+        level_format = "<BBlH{0}f{0}f{0}f{0}L".format(channels)
+        slot_format = "<L{0}f{0}f{0}f{0}L".format(channels)
+        level_size = struct.calcsize(level_format)
+        slot_size = struct.calcsize(slot_format)
+        header_size = struct.calcsize("<Bl")
+        wake_time = struct.unpack("<Bl", bytes(memory[offset:offset + header_size]))[1]
+        self._offset = wake_time - int(base_time)
+        for level in self.levels:
+            level.bucket = None
+            level.head = 0
+            level.length = 0
+            for channel in range(channels):
+                level.open_count[channel] = 0
+        position = offset + header_size
+        for _ in range(saved):
+            header = struct.unpack(level_format, bytes(memory[position:position + level_size]))
+            position += level_size
+            level = self.levels[header[0]]
+            level.bucket = header[2] if header[1] else None
+            count = header[3]
+            for channel in range(channels):
+                level.open_min[channel] = header[4 + channel]
+                level.open_max[channel] = header[4 + channels + channel]
+                level.open_sum[channel] = header[4 + 2 * channels + channel]
+                level.open_count[channel] = header[4 + 3 * channels + channel]
+            for slot in range(count):
+                data = struct.unpack(slot_format, bytes(memory[position:position + slot_size]))
+                position += slot_size
+                level.starts[slot] = data[0]
+                for channel in range(channels):
+                    level.mins[channel][slot] = data[1 + channel]
+                    level.maxs[channel][slot] = data[1 + channels + channel]
+                    level.sums[channel][slot] = data[1 + 2 * channels + channel]
+                    level.counts[channel][slot] = data[1 + 3 * channels + channel]
+            level.head = count % level.size
+            level.length = count
+        return position - offset
+
+    def _open(self, channel, index):
+        """Combine the open buckets of a level and every finer level."""
+        low = high = None
+        total = 0.0
+        count = 0
+        for level in self.levels[:index + 1]:
+            if level.open_count[channel]:
+                if count == 0:
+                    low = level.open_min[channel]
+                    high = level.open_max[channel]
+                else:
+                    low = min(low, level.open_min[channel])
+                    high = max(high, level.open_max[channel])
+                total += level.open_sum[channel]
+                count += level.open_count[channel]
+        return low, high, total, count
+
+    def summary(self, channel, seconds, now):
+        """Return (minimum, maximum, mean, count) over the last `seconds` seconds.
+        Buckets are included whole, so the range is rounded out to the level's bucket size.
+        Minimum, maximum and mean are None if there are no samples in the range.
+        """
+        low = high = None
+        total = 0.0
+        count = 0
+        for _, bucket_low, bucket_high, mean, bucket_count in self.buckets(channel, seconds, now):
+            if count == 0:
+                low = bucket_low
+                high = bucket_high
+            else:
+                low = min(low, bucket_low)
+                high = max(high, bucket_high)
+            total += mean * bucket_count
+            count += bucket_count
+        if count == 0:
+            return None, None, None, 0
+        return low, high, total / count, count
@@ -1,14 +1,15 @@
-import time, board, digitalio, analogio
+import time, board, digitalio, analogio, struct
+from array import array
 
 _is_setup = False
+_samples = 1
+_reading = array('f', [0.0, 0.0, 0.0])
+_heater_time = None
 
 class Mics6814Reading(object):
-    __slots__ = 'oxidising', 'reducing', 'nh3', "_OX", "_RED", "_NH3"
+    __slots__ = 'oxidising', 'reducing', 'nh3'
 
-    def __init__(self, ox, red, nh3, OX, RED, NH3):
-        self._OX = OX
-        self._RED = RED
-        self._NH3 = NH3
+    def __init__(self, ox, red, nh3):
         self.oxidising = ox
         self.reducing = red
         self.nh3 = nh3
@@ -26,7 +27,7 @@ NH3: {nh3:05.03f} Ohms"""
 
 
 def setup():
-    global _is_setup, enable, OX, RED, NH3
+    global _is_setup, _heater_time, enable, OX, RED, NH3
     if _is_setup:
         return
     _is_setup = True
@@ -35,6 +36,7 @@ def setup():
     enable = digitalio.DigitalInOut(board.A3)
     enable.direction = digitalio.Direction.OUTPUT
     enable.value = True
+    _heater_time = time.monotonic()
 
     OX = analogio.AnalogIn(board.A2)
     RED = analogio.AnalogIn(board.A1)
@@ -42,50 +44,239 @@ def setup():
     
 
 def cleanup():
-    enable.value = False
+    set_heater(False)
 
 
-def read_all():
-    """Return gas resistance for oxidising, reducing and NH3"""
+def set_heater(on=True):
+    """Switch the sensor heater on or off.
+    Readings drift for several minutes after the heater comes on, see `Mics6814Baseline`.
+    """
+    global _heater_time
     setup()
+    if on and not enable.value:
+        _heater_time = time.monotonic()
+    elif not on:
+        _heater_time = None
+    enable.value = on
+
+
+def heater_time():
+    """Return the time.monotonic() at which the heater was switched on, or None if it is off."""
+    return _heater_time
+
+
+def set_oversampling(samples=1):
+    """Set how many ADC samples are taken per channel for each reading.
+    Samples are interleaved across the three channels. With 3 or more samples
+    the highest and lowest of each channel are dropped before averaging.
+    :param samples: Number of samples per channel, 1 to disable oversampling
+    """
+    global _samples
+    if samples < 1:
+        raise ValueError("Sample count must be at least 1")
+    _samples = samples
+
+
+def _resistance(total, low, high, count):
+    """Convert the sum of count raw ADC values to a resistance in Ohms, using integer maths only.
+    With 3 or more values the low and high values are dropped first.
+    Simplified from:
+    56000 * (1/ (reference_voltage/(value * (reference_voltage / 65535)) -1))
+    """
+    if count >= 3:
+        total -= low + high
+        count -= 2
+    denominator = 65535 * count - total
+    if total == 0 or denominator <= 0:
+        return 0
+    return 56000 * total // denominator
+
+
+def _read_channel(channel, samples):
+    """Read a single channel, without touching the other two."""
+    if samples is None:
+        samples = _samples
+
+    total = 0
+    low = 65535
+    high = 0
+
+    for _ in range(samples):
+        value = channel.value
+        total += value
+        low = min(low, value)
+        high = max(high, value)
+
+    return _resistance(total, low, high, samples)
+
+
+def read_into(buffer, samples=None):
+    """Write gas resistance for oxidising, reducing and NH3 into buffer[0:3]
+    Avoids creating a reading object, for logging at a high rate.
+    :param buffer: A caller provided array('f') or similar with room for 3 values
+    :param samples: Number of samples per channel, defaults to the `set_oversampling` count
+    """
+    setup()
+
+    if samples is None:
+        samples = _samples
 
-    try:
-        ox = 56000/((65535/OX.value)-1)
-        # Simplified from:
-        # ox = 56000 * (1/ (OX.reference_voltage/(OX.value * (OX.reference_voltage / 65535)) -1))
-    except ZeroDivisionError:
-        ox = 0
+    ox = red = nh3 = 0
+    ox_low = red_low = nh3_low = 65535
+    ox_high = red_high = nh3_high = 0
 
-    try:
-        red = 56000/((65535/RED.value)-1)
-    except ZeroDivisionError:
-        red = 0
+    for _ in range(samples):
+        value = OX.value
+        ox += value
+        ox_low = min(ox_low, value)
+        ox_high = max(ox_high, value)
 
-    try:
-        nh3 = 56000/((65535/NH3.value)-1)
-    except ZeroDivisionError:
-        nh3 = 0
+        value = RED.value
+        red += value
+        red_low = min(red_low, value)
+        red_high = max(red_high, value)
 
-    return Mics6814Reading(ox, red, nh3, OX, RED, NH3)
+        value = NH3.value
+        nh3 += value
+        nh3_low = min(nh3_low, value)
+        nh3_high = max(nh3_high, value)
 
+    buffer[0] = _resistance(ox, ox_low, ox_high, samples)
+    buffer[1] = _resistance(red, red_low, red_high, samples)
+    buffer[2] = _resistance(nh3, nh3_low, nh3_high, samples)
+    return buffer
 
-def read_oxidising():
+
+def read_all(samples=None):
+    """Return gas resistance for oxidising, reducing and NH3
+    :param samples: Number of samples per channel, defaults to the `set_oversampling` count
+    """
+    read_into(_reading, samples)
+    return Mics6814Reading(_reading[0], _reading[1], _reading[2])
+
+
+def read_oxidising(samples=None):
     """Return gas resistance for oxidising gases.
     Eg chlorine, nitrous oxide
     """
     setup()
-    return read_all().oxidising
+    return _read_channel(OX, samples)
 
 
-def read_reducing():
+def read_reducing(samples=None):
     """Return gas resistance for reducing gases.
     Eg hydrogen, carbon monoxide
     """
     setup()
-    return read_all().reducing
+    return _read_channel(RED, samples)
 
 
-def read_nh3():
+def read_nh3(samples=None):
     """Return gas resistance for nh3/ammonia"""
     setup()
-    return read_all().nh3
\ No newline at end of file
+    return _read_channel(NH3, samples)
+
+
+class Mics6814Baseline(object):
+    """Warm-up tracking and baseline drift compensation.
+    Feed every reading to `update`. The sensor counts as warm once the heater has been on
+    for `warm_up_time` seconds and consecutive readings change by less than `stability`.
+    Switching the heater off, or off and on again between readings, starts warm-up over.
+    From then on a rolling baseline resistance R0 is kept per channel, an exponential
+    average with a `time_constant` in seconds, and readings are reported as Rs/R0 ratios.
+    The baseline can be persisted across reboots in a writable buffer such as
+    `microcontroller.nvm`, it is loaded on start and saved at most every `save_interval` seconds
+    to spare the flash.
+    :param store: Writable buffer to keep the baseline in, or None to not persist it
+    :param store_offset: Index of the 14 bytes used within store
+    :param clock: Function returning the current time in seconds, compatible with time.monotonic()
+    :param heater: Function returning the time by clock at which the heater was switched on,
+        or None while it is off. The default `heater_time` is only valid with time.monotonic()
+    """
+    _MAGIC = 0x3648
+    _FORMAT = "<Hfff"
+
+    def __init__(self, warm_up_time=600.0, stability=0.01, time_constant=86400.0,
+                 store=None, store_offset=0, save_interval=3600.0, clock=time.monotonic,
+                 heater=heater_time):
+        self.warm_up_time = warm_up_time
+        self.stability = stability
+        self.time_constant = time_constant
+        self.save_interval = save_interval
+        self.r0 = array('f', [0.0, 0.0, 0.0])
+        self.ratios = array('f', [1.0, 1.0, 1.0])
+        self.warm = False
+        self._store = store
+        self._store_offset = store_offset
+        self._clock = clock
+        self._heater = heater
+        self._heater_start = None
+        self._last = array('f', [0.0, 0.0, 0.0])
+        self._last_time = None
+        self._save_time = clock()
+        self.load()
+
+    def load(self):
+        """Load the baseline from the store, returns True if a saved baseline was found."""
+        if self._store is None:
+            return False
+        size = struct.calcsize(self._FORMAT)
+        magic, ox, red, nh3 = struct.unpack(self._FORMAT, bytes(self._store[self._store_offset:self._store_offset + size]))
+        if magic != self._MAGIC:
+            return False
+        self.r0[0] = ox
+        self.r0[1] = red
+        self.r0[2] = nh3
+        return True
+
+    def save(self):
+        """Save the baseline to the store."""
+        if self._store is None:
+            return
+        data = struct.pack(self._FORMAT, self._MAGIC, self.r0[0], self.r0[1], self.r0[2])
+        self._store[self._store_offset:self._store_offset + len(data)] = data
+        self._save_time = self._clock()
+
+    def update(self, reading):
+        """Track warm-up and the baseline, returns the Rs/R0 ratios.
+        Until the sensor is warm and a baseline exists the ratios are left at their last value.
+        :param reading: A Mics6814Reading, or a buffer of oxidising, reducing and NH3 resistances as filled by `read_into`
+        """
+        if isinstance(reading, Mics6814Reading):
+            reading = (reading.oxidising, reading.reducing, reading.nh3)
+
+        now = self._clock()
+        start = self._heater()
+
+        if start != self._heater_start:
+            # The heater was switched off or cycled, readings since then are from a cold sensor
+            self._heater_start = start
+            self.warm = False
+            self._last_time = None
+
+        if start is not None and not self.warm and self._last_time is not None and \
+                now - start >= self.warm_up_time:
+            self.warm = True
+            for x in range(3):
+                if abs(reading[x] - self._last[x]) > self.stability * self._last[x]:
+                    self.warm = False
+
+        if self.warm:
+            dt = now - self._last_time if self._last_time is not None else 0
+            alpha = min(1.0, dt / self.time_constant)
+            for x in range(3):
+                if self.r0[x] == 0:
+                    self.r0[x] = reading[x]
+                else:
+                    self.r0[x] += (reading[x] - self.r0[x]) * alpha
+                if self.r0[x] > 0:
+                    self.ratios[x] = reading[x] / self.r0[x]
+
+            if now - self._save_time >= self.save_interval:
+                self.save()
+
+        for x in range(3):
+            self._last[x] = reading[x]
+        self._last_time = now
+
+        return self.ratios
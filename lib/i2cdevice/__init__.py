@@ -104,8 +104,101 @@ class _RegisterProxy(object):
         self.device.unlock_register(self.register.name)
 
 
+class _RegisterBlock(object):
+    """Register Block
+    A group of registers that are read together. Registers at contiguous addresses
+    are fetched in a single auto-increment transaction and the bytes are fanned back
+    out into the device values.
+    The grouping is worked out once, so a block can be kept around and re-read cheaply.
+    Used as a context manager the block is read and its registers locked, so
+    device.get() and device.get_field() decode the burst without touching the bus again.
+    """
+    def __init__(self, device, names):
+        self.device = device
+        self.names = tuple(names)
+        self.groups = device._group_registers(self.names)
+
+    def read(self):
+        self.device._read_groups(self.groups)
+
+    def __enter__(self):
+        self.device._read_groups(self.groups)
+        for name in self.names:
+            self.device.lock_register(name)
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        for name in self.names:
+            self.device.unlock_register(name)
+
+
+class _RegisterBatch(object):
+    """Register Batch
+    Stages register writes while active instead of sending them to the device.
+    The first access to a register reads it from the device as usual, after which
+    the shadow copy in device.values is used for every further read-modify-write.
+    On a clean exit only the registers that were written are flushed, with contiguous
+    registers merged into a single burst write. If an exception escapes the batch the
+    staged values are dropped and the registers will be re-read on next access.
+    Batches nest, only the outermost batch flushes.
+    """
+    def __init__(self, device, prefetch):
+        self.device = device
+        self.prefetch = prefetch
+
+    def __enter__(self):
+        device = self.device
+        device._batch_depth += 1
+        if self.prefetch:
+            device.read_block(self.prefetch)
+            for name in self.prefetch:
+                if name not in device._batch_loaded:
+                    device._batch_loaded.append(name)
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        device = self.device
+        device._batch_depth -= 1
+        if device._batch_depth > 0:
+            return
+
+        dirty = device._batch_dirty
+        device._batch_loaded = []
+        device._batch_dirty = []
+
+        if exception_type is None:
+            if dirty:
+                device.write_block(dirty)
+        else:
+            for name in dirty:
+                device.registers[name].is_read = False
+
+
+class _FieldCodec(object):
+    """Field Codec
+    Holds everything needed to pack/unpack a field, resolved once when the
+    register is defined so that get_field and set_field never have to work
+    out shifts or walk adapter lookup tables at access time.
+    """
+    __slots__ = ('name', 'mask', 'shift', 'decode', 'encode')
+
+    def __init__(self, field, bit_width):
+        self.name = field.name
+        self.mask = field.mask
+        self.shift = _trailing_zeros(field.mask, bit_width)
+        self.decode = None
+        self.encode = None
+        if field.adapter is not None:
+            self.decode = field.adapter._decode
+            self.encode = field.adapter._encode
+
+
 class Register():
-    """Store information about an i2c register"""
+    """Store information about an i2c register
+    Registers marked volatile=False (configuration registers the device never changes
+    by itself) are read once, then served from the shadow copy and kept up to date by
+    writes until `Device.invalidate` is called.
+    """
     def __init__(self, name, address, fields=None, bit_width=8, read_only=False, volatile=True):
         self.name = name
         self.address = address
@@ -114,9 +207,11 @@ class Register():
         self.volatile = volatile
         self.is_read = False
         self.fields = {}
+        self.codecs = {}
 
         for field in fields:
             self.fields[field.name] = field
+            self.codecs[field.name] = _FieldCodec(field, bit_width)
 
         self.namedtuple = namedtuple(self.name, sorted(self.fields))
 
@@ -164,6 +259,22 @@ class Device(object):
             self.registers[register.name] = register
             self.__dict__[register.name] = _RegisterProxy(self, register)
 
+        # Preallocated transfer buffer, one address byte followed by enough room
+        # to burst read or write every register in a single transaction
+        span = 0
+        if self.registers:
+            first = min([register.address for register in self.registers.values()])
+            span = max([register.address + register.bit_width // self._bit_width
+                        for register in self.registers.values()]) - first
+        self._buffer = bytearray(span + 1)
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._batch_depth = 0
+        self._batch_loaded = []
+        self._batch_dirty = []
+
     def lock_register(self, name):
         self.locked[name] = True
 
@@ -172,14 +283,114 @@ class Device(object):
 
     def read_register(self, name):
         register = self.registers[name]
+        if self._batch_depth and name in self._batch_loaded:
+            self.cache_hits += 1
+            return self.values[name]
+        if self._batch_depth:
+            self._batch_loaded.append(name)
         if register.volatile or not register.is_read:
             self.values[register.name] = self._i2c_read(register.address, register.bit_width)
             register.is_read = True
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
         return self.values[register.name]
 
+    def invalidate(self, *names):
+        """Drop cached register values so the next access reads from the device.
+        Non-volatile registers are otherwise only read once and then kept in sync
+        by writes, call this after anything that changes them behind our back,
+        such as a software reset.
+        :param names: Names of registers to invalidate, all registers if none are given.
+        """
+        if not names:
+            names = self.registers.keys()
+        for name in names:
+            self.registers[name].is_read = False
+
+    def read_block(self, names):
+        """Read one or more registers, bursting contiguous addresses.
+        Registers that sit next to each other are read in one auto-increment
+        transaction rather than one transaction per register.
+        :param names: Names of registers to read.
+        """
+        self._read_groups(self._group_registers(names))
+
+    def block(self, *names):
+        """Get a reusable group of registers to read together.
+        See `read_block`, use as a context manager to read and lock the registers.
+        :param names: Names of registers in the group.
+        """
+        return _RegisterBlock(self, names)
+
+    def _group_registers(self, names):
+        """Sort registers by address and split them into runs of contiguous addresses."""
+        registers = sorted([self.registers[name] for name in names], key=lambda register: register.address)
+        groups = []
+        end = None
+        for register in registers:
+            if register.address != end:
+                groups.append([])
+            groups[-1].append(register)
+            end = register.address + register.bit_width // self._bit_width
+        return [tuple(group) for group in groups]
+
+    def _read_groups(self, groups):
+        for group in groups:
+            length = 0
+            for register in group:
+                length += register.bit_width // self._bit_width
+            buffer = self._i2c_transfer_read(self._i2c_address, group[0].address, length)
+            offset = 1
+            for register in group:
+                value = 0
+                for x in range(offset, offset + register.bit_width // self._bit_width):
+                    value <<= 8
+                    value |= buffer[x]
+                offset += register.bit_width // self._bit_width
+                self.values[register.name] = value
+                register.is_read = True
+
+    def batch(self, *names):
+        """Get a context in which register writes are staged and flushed together.
+        Field writes across any number of registers are applied to a shadow copy
+        and only the registers that changed are written on exit, contiguous ones
+        in a single burst.
+        :param names: Optional names of registers to prefetch in one burst read on entry.
+        """
+        return _RegisterBatch(self, names)
+
+    def write_block(self, names):
+        """Write one or more registers from device.values, bursting contiguous addresses.
+        :param names: Names of registers to write.
+        """
+        for group in self._group_registers(names):
+            length = 0
+            for register in group:
+                length += register.bit_width // self._bit_width
+            buffer = self._scratch(length)
+            buffer[0] = group[0].address
+            offset = 1
+            for register in group:
+                value = self.values[register.name]
+                size = register.bit_width // self._bit_width
+                for x in range(offset + size - 1, offset - 1, -1):
+                    buffer[x] = value & 0xff
+                    value >>= 8
+                offset += size
+            self._i2c_transfer_write(self._i2c_address, buffer, length)
+            for register in group:
+                register.is_read = True
+
     def write_register(self, name):
         register = self.registers[name]
-        return self._i2c_write(register.address, self.values[register.name], register.bit_width)
+        if self._batch_depth:
+            if name not in self._batch_dirty:
+                self._batch_dirty.append(name)
+            return
+        self._i2c_write(register.address, self.values[register.name], register.bit_width)
+        # Write-through, the shadow value now matches the device
+        register.is_read = True
 
     def get_addresses(self):
         return self._i2c_addresses
@@ -215,89 +426,113 @@ class Device(object):
         :param register: Name of register to retrieve
         """
         result = {}
-        self.read_register(register)
-        self.lock_register(register)
+        locked = self.locked[register]
+        if not locked:
+            self.read_register(register)
+            self.lock_register(register)
         for field in self.registers[register].fields:
             result[field] = self.get_field(register, field)
-        self.unlock_register(register)
+        if not locked:
+            self.unlock_register(register)
         return self.registers[register].namedtuple(**result)
 
     def get_field(self, register, field):
-        register = self.registers[register]
-        field = register.fields[field]
-
-        if not self.locked[register.name]:
-            self.read_register(register.name)
+        codec = self.registers[register].codecs[field]
 
-        value = self.values[register.name]
+        if not self.locked[register]:
+            self.read_register(register)
 
-        value = (value & field.mask) >> _trailing_zeros(field.mask, register.bit_width)
+        value = (self.values[register] & codec.mask) >> codec.shift
 
-        if field.adapter is not None:
+        if codec.decode is not None:
             try:
-                value = field.adapter._decode(value)
+                value = codec.decode(value)
             except ValueError as value_error:
-                raise ValueError("{}: {}".format(field.name, str(value_error)))
+                raise ValueError("{}: {}".format(codec.name, str(value_error)))
 
         return value
 
     def set_field(self, register, field, value):
-        register = self.registers[register]
-        field = register.fields[field]
-        shift = _trailing_zeros(field.mask, register.bit_width)
-
-        if field.adapter is not None:
-            value = field.adapter._encode(value)
+        codec = self.registers[register].codecs[field]
 
-        if not self.locked[register.name]:
-            self.read_register(register.name)
+        if codec.encode is not None:
+            value = codec.encode(value)
 
-        reg_value = self.values[register.name]
+        locked = self.locked[register]
 
-        reg_value &= ~field.mask
-        reg_value |= (value << shift) & field.mask
+        if not locked:
+            self.read_register(register)
 
-        self.values[register.name] = reg_value
+        reg_value = self.values[register] & ~codec.mask
+        self.values[register] = reg_value | ((value << codec.shift) & codec.mask)
 
-        if not self.locked[register.name]:
-            self.write_register(register.name)
+        if not locked:
+            self.write_register(register)
 
     def get_register(self, register):
         register = self.registers[register]
         return self._i2c_read(register.address, register.bit_width)
 
+    def _scratch(self, length):
+        """Get the transfer buffer, with room for a register address byte plus length bytes.
+        The buffer is allocated once up front and only grows if a longer transfer is requested.
+        """
+        if len(self._buffer) < length + 1:
+            self._buffer = bytearray(length + 1)
+        return self._buffer
+
     def _i2c_write(self, register, value, bit_width):
-        values = _int_to_bytes(value, bit_width // self._bit_width, 'big')
-        values = list(values)
-        self._write_i2c_block_data(self._i2c_address, register, values)
+        length = bit_width // self._bit_width
+        buffer = self._scratch(length)
+        buffer[0] = register
+        for x in range(length, 0, -1):
+            buffer[x] = value & 0xff
+            value >>= 8
+        self._i2c_transfer_write(self._i2c_address, buffer, length)
 
     def _i2c_read(self, register, bit_width):
+        length = bit_width // self._bit_width
+        buffer = self._i2c_transfer_read(self._i2c_address, register, length)
         value = 0
-        for x in self._read_i2c_block_data(self._i2c_address, register, bit_width // self._bit_width):
+        for x in range(1, length + 1):
             value <<= 8
-            value |= x
+            value |= buffer[x]
         return value
 
-    def _write_i2c_block_data(self, i2c_address, register, values):
+    def _i2c_transfer_write(self, i2c_address, buffer, length):
+        """Write the register address in buffer[0] followed by length bytes, without allocating."""
         while not self._i2c.try_lock():
             pass
         try:
-            self._i2c.writeto(i2c_address, bytes([register] + values))
-            
+            self._i2c.writeto(i2c_address, buffer, end=length + 1)
         finally:
             self._i2c.unlock()
 
-    def _read_i2c_block_data(self, i2c_address, register, bit_width):
+    def _i2c_transfer_read(self, i2c_address, register, length):
+        """Read length bytes from register into buffer[1:], without allocating.
+        Returns the transfer buffer, which is only valid until the next transfer.
+        """
+        buffer = self._scratch(length)
+        buffer[0] = register
         while not self._i2c.try_lock():
             pass
         try:
-            self._i2c.writeto(i2c_address, bytes([register]), stop=False)
-            buffer = bytearray(bit_width)
-            self._i2c.readfrom_into(i2c_address, buffer)
-            return list(buffer)
-
+            self._i2c.writeto_then_readfrom(i2c_address, buffer, buffer,
+                                            out_end=1, in_start=1, in_end=length + 1)
         finally:
             self._i2c.unlock()
+        return buffer
+
+    def _write_i2c_block_data(self, i2c_address, register, values):
+        buffer = self._scratch(len(values))
+        buffer[0] = register
+        for x, value in enumerate(values):
+            buffer[x + 1] = value
+        self._i2c_transfer_write(i2c_address, buffer, len(values))
+
+    def _read_i2c_block_data(self, i2c_address, register, bit_width):
+        buffer = self._i2c_transfer_read(i2c_address, register, bit_width)
+        return list(buffer[1:bit_width + 1])
 
     def _readfrom_mem(self, i2c_address, register, num_bytes):
         return self._read_i2c_block_data(i2c_address, register, num_bytes)
@@ -16,16 +16,24 @@ class LookupAdapter(Adapter):
     def __init__(self, lookup_table, snap=True):
         self.lookup_table = lookup_table
         self.snap = snap
+        # Reverse table for constant time decoding, first key wins on duplicate values
+        self._reverse_table = {}
+        for k, v in lookup_table.items():
+            if v not in self._reverse_table:
+                self._reverse_table[v] = k
+        self._snap_keys = [k for k in lookup_table.keys() if type(k) in [int, float, bool]]
 
     def _decode(self, value):
-        for k, v in self.lookup_table.items():
-            if v == value:
-                return k
-        raise ValueError("{} not in lookup table".format(value))
+        try:
+            return self._reverse_table[value]
+        except KeyError:
+            raise ValueError("{} not in lookup table".format(value))
 
     def _encode(self, value):
+        if value in self.lookup_table:
+            return self.lookup_table[value]
         if self.snap and type(value) in [int, float]:
-            value = min(list(self.lookup_table.keys()), key=lambda x: abs(x - value))
+            value = min(self._snap_keys, key=lambda x: abs(x - value))
         return self.lookup_table[value]
 
 
@@ -0,0 +1,396 @@
+"""Simulated I2C bus and peripherals for running drivers on a host.
+
+`SimulatedI2C` implements the `busio.I2C` surface used by i2cdevice and
+adafruit_bus_device, so it can be passed anywhere a real bus is expected.
+Peripherals are attached at an address and see each transaction as a
+write of some bytes or a read of some length, through their `write(data)`
+and `read(length)` methods. They may also provide `write_from` and
+`read_into` to work on the caller's buffer in place.
+
+Every transaction is charged a fixed latency plus a per-byte cost from the
+byte rate. The total is accumulated in `elapsed` and optionally slept for
+real, so benchmarks can report bus time without needing hardware.
+"""
+import random
+import struct
+import time
+
+
+class RegisterPeripheral:
+    """A register mapped device with an auto-incrementing register pointer.
+    A write sets the pointer from the first byte and stores any following bytes,
+    a read returns bytes from the pointer onwards. The pointer persists between
+    transactions so split write/read transfers behave like the real thing.
+    `write_from` and `read_into` work on the caller's buffer without allocating,
+    so the bus itself doesn't show up when measuring a driver's allocations.
+    :param defaults: A dictionary of register address to power-on value
+    """
+    def __init__(self, defaults=None, size=256):
+        self.regs = bytearray(size)
+        self.pointer = 0
+        self.defaults = defaults or {}
+        self.reset()
+
+    def reset(self):
+        for x in range(len(self.regs)):
+            self.regs[x] = 0
+        for register, value in self.defaults.items():
+            self.regs[register] = value
+
+    def write(self, data):
+        self.write_from(data, 0, len(data))
+
+    def write_from(self, buffer, start, end):
+        if end <= start:
+            return
+        self.pointer = buffer[start]
+        for x in range(start + 1, end):
+            self.write_register(self.pointer, buffer[x])
+            self.pointer = (self.pointer + 1) % len(self.regs)
+
+    def write_register(self, register, value):
+        self.regs[register] = value
+
+    def read(self, length):
+        result = bytearray(length)
+        self.read_into(result, 0, length)
+        return result
+
+    def read_into(self, buffer, start, end):
+        for x in range(start, end):
+            buffer[x] = self.read_register(self.pointer)
+            self.pointer = (self.pointer + 1) % len(self.regs)
+
+    def read_register(self, register):
+        return self.regs[register]
+
+
+class LTR559Peripheral(RegisterPeripheral):
+    """LITE-ON LTR559 light and proximity sensor personality.
+    Use `set_light` and `set_proximity` to present new measurements, these set the
+    new data flags in ALS_PS_STATUS which are cleared when the status is read.
+    """
+    ADDRESS = 0x23
+
+    def __init__(self):
+        RegisterPeripheral.__init__(self, defaults={
+            0x82: 0x7F,  # PS_LED
+            0x83: 0x01,  # PS_N_PULSES
+            0x84: 0x02,  # PS_MEAS_RATE
+            0x85: 0x03,  # ALS_MEAS_RATE
+            0x86: 0x92,  # PART_ID
+            0x87: 0x05,  # MANUFACTURER_ID
+            0x90: 0xFF,  # PS_THRESHOLD upper
+            0x91: 0x07,
+            0x97: 0xFF,  # ALS_THRESHOLD upper
+            0x98: 0xFF,
+        })
+
+    def write_register(self, register, value):
+        if register == 0x80 and value & 0b10:
+            self.reset()
+            return
+        self.regs[register] = value
+
+    def read_register(self, register):
+        value = self.regs[register]
+        if register == 0x8C:
+            # Reading the status clears the new data and interrupt flags
+            self.regs[register] &= 0b11110000
+        return value
+
+    def set_light(self, ch0, ch1):
+        struct.pack_into("<HH", self.regs, 0x88, ch1, ch0)
+        # Report the gain the sample was taken with alongside the new data flag
+        gain = (self.regs[0x80] >> 2) & 0b111
+        self.regs[0x8C] = (self.regs[0x8C] & 0b00001011) | (gain << 4) | 0b0100
+        if self.regs[0x8F] & 0b10 and not self._in_range(ch0, 0x97):
+            self.regs[0x8C] |= 0b1000
+
+    def set_proximity(self, value):
+        self.regs[0x8D] = value & 0xFF
+        self.regs[0x8E] = (value >> 8) & 0x07
+        self.regs[0x8C] |= 0b0001
+        if self.regs[0x8F] & 0b01:
+            upper = self.regs[0x90] | (self.regs[0x91] & 0x0F) << 8
+            lower = self.regs[0x92] | (self.regs[0x93] & 0x0F) << 8
+            if value > upper or value < lower:
+                self.regs[0x8C] |= 0b0010
+
+    def _in_range(self, value, register):
+        upper, lower = struct.unpack_from("<HH", self.regs, register)
+        return lower <= value <= upper
+
+    @property
+    def interrupt(self):
+        """True while an ALS or PS interrupt is pending."""
+        return bool(self.regs[0x8C] & 0b1010)
+
+
+class InterruptPin:
+    """Stand in for a `digitalio.DigitalInOut` input wired to a peripheral's interrupt output.
+    :param peripheral: A peripheral with an `interrupt` property
+    :param active_high: True if the pin is driven high while the interrupt is pending
+    """
+    def __init__(self, peripheral, active_high=True):
+        self.peripheral = peripheral
+        self.active_high = active_high
+
+    @property
+    def value(self):
+        return self.peripheral.interrupt == self.active_high
+
+
+class AnalogInput:
+    """Stand in for an `analogio.AnalogIn`, such as the battery voltage monitor.
+    :param voltage: Voltage presented at the pin
+    :param reference_voltage: Voltage of a full scale reading
+    """
+    def __init__(self, voltage=0.0, reference_voltage=3.3):
+        self.voltage = voltage
+        self.reference_voltage = reference_voltage
+
+    @property
+    def value(self):
+        return max(0, min(65535, int(self.voltage / self.reference_voltage * 65535)))
+
+
+class BME280Peripheral(RegisterPeripheral):
+    """Bosch BME280 temperature, pressure and humidity sensor personality.
+    Uses the compensation parameters from the datasheet example, the default raw
+    readings come out at roughly 25C, 1006hPa and 43%RH.
+    """
+    ADDRESS = 0x76
+
+    # dig_T1..T3, dig_P1..P9 from the BME280 datasheet, section 8.2
+    TEMP_PRESS_CALIBRATION = (27504, 26435, -1000,
+                              36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+    HUMIDITY_CALIBRATION = (75, 362, 0, 313, 50, 30)
+
+    def __init__(self):
+        defaults = {0xD0: 0x60}  # CHIP_ID
+        calibration = struct.pack("<HhhHhhhhhhhh", *self.TEMP_PRESS_CALIBRATION)
+        for x, value in enumerate(calibration):
+            defaults[0x88 + x] = value
+        h1, h2, h3, h4, h5, h6 = self.HUMIDITY_CALIBRATION
+        defaults[0xA1] = h1
+        defaults[0xE1] = h2 & 0xFF
+        defaults[0xE2] = (h2 >> 8) & 0xFF
+        defaults[0xE3] = h3
+        defaults[0xE4] = (h4 >> 4) & 0xFF
+        defaults[0xE5] = (h4 & 0x0F) | ((h5 & 0x0F) << 4)
+        defaults[0xE6] = (h5 >> 4) & 0xFF
+        defaults[0xE7] = h6 & 0xFF
+        self.raw = (519888, 415148, 27000)
+        RegisterPeripheral.__init__(self, defaults=defaults)
+
+    def reset(self):
+        RegisterPeripheral.reset(self)
+        self.set_raw(*self.raw)
+
+    def write_register(self, register, value):
+        if register == 0xE0:
+            if value == 0xB6:
+                self.reset()
+            return
+        self.regs[register] = value
+
+    def set_raw(self, temperature, pressure, humidity):
+        """Set the raw 20 bit temperature and pressure and 16 bit humidity ADC values."""
+        self.raw = (temperature, pressure, humidity)
+        for register, value in ((0xF7, pressure), (0xFA, temperature)):
+            self.regs[register] = (value >> 12) & 0xFF
+            self.regs[register + 1] = (value >> 4) & 0xFF
+            self.regs[register + 2] = (value & 0x0F) << 4
+        self.regs[0xFD] = (humidity >> 8) & 0xFF
+        self.regs[0xFE] = humidity & 0xFF
+
+
+class SGP30Peripheral:
+    """Sensirion SGP30 air quality sensor personality.
+    Implements the command set used by adafruit_sgp30, with CRC protected replies.
+    Set `eco2`, `tvoc`, `h2` and `ethanol` to change what measurements return.
+    """
+    ADDRESS = 0x58
+
+    def __init__(self, serial=(0x0000, 0x0123, 0x4567), featureset=0x0020):
+        self.serial = serial
+        self.featureset = featureset
+        self.eco2 = 400
+        self.tvoc = 0
+        self.h2 = 13000
+        self.ethanol = 18000
+        self.baseline = [0x8973, 0x8AAE]
+        self.humidity = 0
+        self._reply = b''
+
+    def write(self, data):
+        if len(data) < 2:
+            return
+        command = (data[0] << 8) | data[1]
+        args = self._words(data[2:])
+        reply = ()
+        if command == 0x3682:
+            reply = self.serial
+        elif command == 0x202F:
+            reply = (self.featureset,)
+        elif command == 0x2008:
+            reply = (self.eco2, self.tvoc)
+        elif command == 0x2050:
+            reply = (self.h2, self.ethanol)
+        elif command == 0x2015:
+            reply = tuple(self.baseline)
+        elif command == 0x201E and len(args) == 2:
+            # Arguments are sent TVOC first, baseline is reported eCO2 first
+            self.baseline = [args[1], args[0]]
+        elif command == 0x2061 and len(args) == 1:
+            self.humidity = args[0]
+        self._reply = self._pack(reply)
+
+    def read(self, length):
+        result = bytearray(length)
+        for x in range(min(length, len(self._reply))):
+            result[x] = self._reply[x]
+        self._reply = b''
+        return result
+
+    def _words(self, data):
+        words = []
+        for x in range(0, len(data) - 2, 3):
+            if self.crc(data[x:x + 2]) == data[x + 2]:
+                words.append((data[x] << 8) | data[x + 1])
+        return words
+
+    def _pack(self, words):
+        result = bytearray()
+        for word in words:
+            pair = bytes(((word >> 8) & 0xFF, word & 0xFF))
+            result += pair
+            result.append(self.crc(pair))
+        return result
+
+    @staticmethod
+    def crc(data):
+        crc = 0xFF
+        for byte in data:
+            crc ^= byte
+            for _ in range(8):
+                if crc & 0x80:
+                    crc = (crc << 1) ^ 0x31
+                else:
+                    crc <<= 1
+        return crc & 0xFF
+
+
+class SimulatedI2C:
+    """A host side stand in for `busio.I2C`.
+    :param latency: Fixed cost of each transaction in seconds
+    :param byte_rate: Bytes per second transferred, or None for no per-byte cost.
+        100kHz I2C moves roughly 11000 bytes per second.
+    :param fault_rate: Probability from 0.0 to 1.0 that any transaction fails with OSError
+    :param realtime: Sleep for the simulated bus time instead of only accounting for it
+    """
+    def __init__(self, latency=0.0, byte_rate=None, fault_rate=0.0, realtime=False):
+        self.latency = latency
+        self.byte_rate = byte_rate
+        self.fault_rate = fault_rate
+        self.realtime = realtime
+        self.peripherals = {}
+        self.locked = False
+        self.transactions = 0
+        self.bytes_transferred = 0
+        self.faults = 0
+        self.elapsed = 0.0
+        self._fail_next = 0
+
+    def attach(self, peripheral, address=None):
+        """Attach a peripheral, at its default ADDRESS if none is given."""
+        if address is None:
+            address = peripheral.ADDRESS
+        self.peripherals[address] = peripheral
+        return peripheral
+
+    def fail_next(self, count=1):
+        """Make the next count transactions fail, for deterministic fault tests."""
+        self._fail_next += count
+
+    def reset_stats(self):
+        self.transactions = 0
+        self.bytes_transferred = 0
+        self.faults = 0
+        self.elapsed = 0.0
+
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def unlock(self):
+        self.locked = False
+
+    def deinit(self):
+        self.peripherals = {}
+
+    def scan(self):
+        return sorted(self.peripherals.keys())
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        if end is None:
+            end = len(buffer)
+        peripheral = self._transaction(address, end - start)
+        self._write(peripheral, buffer, start, end)
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        if end is None:
+            end = len(buffer)
+        peripheral = self._transaction(address, end - start)
+        self._read(peripheral, buffer, start, end)
+
+    def writeto_then_readfrom(self, address, out_buffer, in_buffer, *,
+                              out_start=0, out_end=None, in_start=0, in_end=None):
+        if out_end is None:
+            out_end = len(out_buffer)
+        if in_end is None:
+            in_end = len(in_buffer)
+        # A repeated start is a single transaction on the bus
+        peripheral = self._transaction(address, (out_end - out_start) + (in_end - in_start))
+        self._write(peripheral, out_buffer, out_start, out_end)
+        self._read(peripheral, in_buffer, in_start, in_end)
+
+    @staticmethod
+    def _write(peripheral, buffer, start, end):
+        if hasattr(peripheral, 'write_from'):
+            peripheral.write_from(buffer, start, end)
+        else:
+            peripheral.write(bytes(buffer[start:end]))
+
+    @staticmethod
+    def _read(peripheral, buffer, start, end):
+        if hasattr(peripheral, 'read_into'):
+            peripheral.read_into(buffer, start, end)
+            return
+        data = peripheral.read(end - start)
+        for x in range(end - start):
+            buffer[start + x] = data[x]
+
+    def _transaction(self, address, length):
+        self.transactions += 1
+        self.bytes_transferred += length
+        # Address byte plus payload
+        cost = self.latency
+        if self.byte_rate:
+            cost += (length + 1) / self.byte_rate
+        self.elapsed += cost
+        if self.realtime and cost > 0:
+            time.sleep(cost)
+
+        if self._fail_next > 0 or (self.fault_rate and random.random() < self.fault_rate):
+            self._fail_next = max(0, self._fail_next - 1)
+            self.faults += 1
+            raise OSError(5)  # EIO, as a NAK mid-transfer
+
+        try:
+            return self.peripherals[address]
+        except KeyError:
+            raise OSError(19)  # ENODEV, nothing acknowledged the address
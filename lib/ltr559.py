@@ -1,14 +1,96 @@
 """Library for the LITE-ON LTR559 digital light and proximity sensor."""
 import time
+from array import array
 from i2cdevice import Device, Register, BitField
 from i2cdevice.adapter import Adapter, LookupAdapter, U16ByteSwapAdapter
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __version__ = '0.1.0'
 
 I2C_ADDR = 0x23
 PART_ID = 0x09
 REVISION_ID = 0x02
 
+ALS_FULL_SCALE = 0xFFFF
+
+# Light measurement repeat rates in ms supported by ALS_MEAS_RATE
+ALS_REPEAT_RATES = (50, 100, 200, 500, 1000, 2000)
+
+# Lux coefficients for ch0 and ch1, picked by which RATIO_BOUNDS bucket the ch1 ratio falls in
+CH0_C = (17743, 42785, 5926, 0)
+CH1_C = (-11059, 19548, -1185, 0)
+RATIO_BOUNDS = (45, 64, 85)
+
+# (gain, integration time in ms) pairs used by auto-ranging, from least to most sensitive.
+# Each step doubles the sensitivity of the previous one, except 8x 100ms -> 48x 50ms which triples it.
+AUTO_RANGES = (
+    (1, 50),
+    (2, 50),
+    (4, 50),
+    (8, 50),
+    (8, 100),
+    (48, 50),
+    (48, 100),
+    (96, 100),
+    (96, 200),
+    (96, 400)
+)
+
+
+def _ratio_index(ratio):
+    if ratio < RATIO_BOUNDS[0]:
+        return 0
+    if ratio < RATIO_BOUNDS[1]:
+        return 1
+    if ratio < RATIO_BOUNDS[2]:
+        return 2
+    return 3
+
+
+def calculate_lux(ch0, ch1, gain, integration_time):
+    """Calculate the ratio and lux for a series of raw light readings.
+    Uses the same maths as `LTR559.update_sensor`, for re-processing logged raw data.
+    With NumPy available the whole series is done with array operations and NumPy arrays
+    are returned, otherwise it falls back to a single loop returning `array('f')`.
+    :param ch0: Sequence of raw ch0 (visible + IR) counts
+    :param ch1: Sequence of raw ch1 (IR) counts
+    :param gain: Gain each reading was taken at, a sequence or a single value for all of them
+    :param integration_time: Integration time in milliseconds, a sequence or a single value
+    :returns: A tuple of (ratio, lux)
+    """
+    if numpy is not None:
+        ch0 = numpy.asarray(ch0, dtype=numpy.float64)
+        ch1 = numpy.asarray(ch1, dtype=numpy.float64)
+        total = ch0 + ch1
+        ratio = numpy.where(total > 0, ch1 * 100 / numpy.where(total > 0, total, 1), 101)
+        index = numpy.searchsorted(RATIO_BOUNDS, ratio, side='right')
+        lux = ch0 * numpy.take(CH0_C, index) - ch1 * numpy.take(CH1_C, index)
+        lux /= numpy.asarray(integration_time, dtype=numpy.float64) / 100.0
+        lux /= numpy.asarray(gain, dtype=numpy.float64)
+        lux /= 10000.0
+        return ratio, lux
+
+    count = len(ch0)
+    if type(gain) in (int, float):
+        gain = (gain,) * count
+    if type(integration_time) in (int, float):
+        integration_time = (integration_time,) * count
+
+    ratio = array('f', [0.0] * count)
+    lux = array('f', [0.0] * count)
+    for x in range(count):
+        als0 = ch0[x]
+        als1 = ch1[x]
+        total = als0 + als1
+        ratio[x] = value = als1 * 100 / total if total > 0 else 101
+        index = _ratio_index(value)
+        lux[x] = (als0 * CH0_C[index] - als1 * CH1_C[index]) / (integration_time[x] * gain[x] * 100.0)
+    return ratio, lux
+
 
 class Bit12Adapter(Adapter):
     def _encode(self, value):
@@ -28,7 +110,8 @@ class Bit12Adapter(Adapter):
 
 
 class LTR559:
-    def __init__(self, i2c_dev=None, enable_interrupts=False, interrupt_pin_polarity=1, timeout=5.0):
+    def __init__(self, i2c_dev=None, enable_interrupts=False, interrupt_pin_polarity=1, timeout=5.0, auto_range=False,
+                 interrupt_pin=None):
         """Initialise the LTR559.
         This sets up the LTR559 and checks that the Part Number ID matches 0x09 and
         that the Revision Number ID matches 0x02. If you come across an unsupported
@@ -37,6 +120,13 @@ class LTR559:
         thresholds are reset to the full range so that interrupts will not fire unless
         configured manually using `set_light_threshold` and `set_proximity_threshold`.
         Interrupts are always enabled, since this must be done before the sensor is active.
+        If auto_range is True the light gain and integration time are adjusted to suit the
+        light level, see `set_auto_range`.
+        If an interrupt_pin is given, interrupts are enabled and `update_sensor` only reads
+        the sensor while the pin is asserted, see `update_sensor`. Since the reset thresholds
+        never assert it, light tracking is turned on with its default window, so an interrupt
+        fires whenever the light level moves. Proximity is read along with each light reading,
+        use `set_proximity_threshold` to be woken by proximity changes as well.
         """
         self._als0 = 0
         self._als1 = 0
@@ -47,9 +137,23 @@ class LTR559:
         # Non default
         self._gain = 4  # 4x gain = 0.25 to 16k lux
         self._integration_time = 50
+        self._repeat_rate = 50
+
+        self._auto_range = False
+        self._range_index = 0
+        self._range_low = 0
+        self._range_high = 0
+        self._settle_cycles = 0
+        self._settle = 0
+
+        self._interrupt_pin = interrupt_pin
+        self._interrupt_active = bool(interrupt_pin_polarity)
+        self._interrupt_primed = False
+        self._light_window = None
+        self._light_window_min = 0
 
-        self._ch0_c = (17743, 42785, 5926, 0)
-        self._ch1_c = (-11059, 19548, -1185, 0)
+        self._ch0_c = CH0_C
+        self._ch1_c = CH1_C
 
         self._ltr559 = Device(I2C_ADDR, i2c_dev=i2c_dev, bit_width=8, registers=(
             Register('ALS_CONTROL', 0x80, fields=(
@@ -62,14 +166,14 @@ class LTR559:
                     96: 0b111})),
                 BitField('sw_reset', 0b00000010),
                 BitField('mode', 0b00000001)
-            )),
+            ), volatile=False),
 
             Register('PS_CONTROL', 0x81, fields=(
                 BitField('saturation_indicator_enable', 0b00100000),
                 BitField('active', 0b00000011, adapter=LookupAdapter({
                     False: 0b00,
                     True: 0b11}))
-            )),
+            ), volatile=False),
 
             Register('PS_LED', 0x82, fields=(
                 BitField('pulse_freq_khz', 0b11100000, adapter=LookupAdapter({
@@ -92,11 +196,11 @@ class LTR559:
                     20: 0b010,
                     50: 0b011,
                     100: 0b100}))
-            )),
+            ), volatile=False),
 
             Register('PS_N_PULSES', 0x83, fields=(
                 BitField('count', 0b00001111),
-            )),
+            ), volatile=False),
 
             Register('PS_MEAS_RATE', 0x84, fields=(
                 BitField('rate_ms', 0b00001111, adapter=LookupAdapter({
@@ -108,7 +212,7 @@ class LTR559:
                     500: 0b0100,
                     1000: 0b0101,
                     2000: 0b0110})),
-            )),
+            ), volatile=False),
 
             Register('ALS_MEAS_RATE', 0x85, fields=(
                 BitField('integration_time_ms', 0b00111000, adapter=LookupAdapter({
@@ -127,7 +231,7 @@ class LTR559:
                     500: 0b011,
                     1000: 0b100,
                     2000: 0b101}))
-            )),
+            ), volatile=False),
 
             Register('PART_ID', 0x86, fields=(
                 BitField('part_number', 0b11110000),  # Should be 0x09H
@@ -136,7 +240,7 @@ class LTR559:
 
             Register('MANUFACTURER_ID', 0x87, fields=(
                 BitField('manufacturer_id', 0b11111111),  # Should be 0x05H
-            ), read_only=True),
+            ), read_only=True, volatile=False),
 
             # This will address 0x88, 0x89, 0x8A and 0x8B as a continuous 32bit register
             Register('ALS_DATA', 0x88, fields=(
@@ -174,18 +278,18 @@ class LTR559:
                     'ps': 0b01,
                     'als': 0b10,
                     'als+ps': 0b11}))
-            )),
+            ), volatile=False),
 
             Register('PS_THRESHOLD', 0x90, fields=(
                 BitField('upper', 0xFF0F0000, adapter=Bit12Adapter()),
                 BitField('lower', 0x0000FF0F, adapter=Bit12Adapter())
-            ), bit_width=32),
+            ), bit_width=32, volatile=False),
 
             # PS_OFFSET defines the measurement offset value to correct for proximity
             # offsets caused by device variations, crosstalk and other environmental factors.
             Register('PS_OFFSET', 0x94, fields=(
                 BitField('offset', 0x03FF),  # Last two bits of 0x94, full 8 bits of 0x95
-            ), bit_width=16),
+            ), bit_width=16, volatile=False),
 
             # Defines the upper and lower limits of the ALS reading.
             # An interrupt is triggered if values fall outside of this range.
@@ -193,7 +297,7 @@ class LTR559:
             Register('ALS_THRESHOLD', 0x97, fields=(
                 BitField('upper', 0xFFFF0000, adapter=U16ByteSwapAdapter(), bit_width=16),
                 BitField('lower', 0x0000FFFF, adapter=U16ByteSwapAdapter(), bit_width=16)
-            ), bit_width=32),
+            ), bit_width=32, volatile=False),
 
             # This register controls how many values must fall outside of the range defined
             # by upper and lower threshold limits before the interrupt is asserted.
@@ -204,10 +308,13 @@ class LTR559:
             Register('INTERRUPT_PERSIST', 0x9E, fields=(
                 BitField('PS', 0xF0),
                 BitField('ALS', 0x0F)
-            ))
+            ), volatile=False)
 
         ))
 
+        # Status, proximity and light data sit at 0x88 - 0x8E so they can be read in one burst
+        self._sample_block = self._ltr559.block('ALS_DATA', 'ALS_PS_STATUS', 'PS_DATA')
+
         """Set up the LTR559 sensor"""
         self.part_id = self._ltr559.get('PART_ID')
         if self.part_id.part_number != PART_ID or self.part_id.revision != REVISION_ID:
@@ -215,8 +322,10 @@ class LTR559:
 
         self._ltr559.set('ALS_CONTROL', sw_reset=1)
 
+        # sw_reset clears itself, so the cached ALS_CONTROL value must be dropped to poll it
         t_start = time.time()
         while time.time() - t_start < timeout:
+            self._ltr559.invalidate('ALS_CONTROL')
             status = self._ltr559.get('ALS_CONTROL').sw_reset
             if status == 0:
                 break
@@ -225,47 +334,60 @@ class LTR559:
         if self._ltr559.get('ALS_CONTROL').sw_reset:
             raise RuntimeError("Timeout waiting for software reset.")
 
+        # The reset puts every register back to its default value
+        self._ltr559.invalidate()
+
         # Interrupt register must be set before device is switched to active mode
         # see datasheet page 12/40, note #2.
-        if enable_interrupts:
+        if enable_interrupts or interrupt_pin is not None:
             self._ltr559.set('INTERRUPT',
                              mode='als+ps',
                              polarity=interrupt_pin_polarity)
 
-        # FIXME use datasheet defaults or document
-        # No need to run the proximity LED at 100mA, so we pick 50 instead.
-        # Tests suggest this works pretty well.
-        self._ltr559.set('PS_LED',
-                         current_ma=50,
-                         duty_cycle=1.0,
-                         pulse_freq_khz=30)
+        # Stage the rest of the configuration and flush it as three burst writes,
+        # 0x80 - 0x85, 0x90 - 0x95 and 0x97 - 0x9A.
+        with self._ltr559.batch('ALS_CONTROL', 'PS_CONTROL', 'PS_LED', 'PS_N_PULSES', 'PS_MEAS_RATE', 'ALS_MEAS_RATE',
+                                'PS_THRESHOLD', 'PS_OFFSET', 'ALS_THRESHOLD'):
+            # FIXME use datasheet defaults or document
+            # No need to run the proximity LED at 100mA, so we pick 50 instead.
+            # Tests suggest this works pretty well.
+            self._ltr559.set('PS_LED',
+                             current_ma=50,
+                             duty_cycle=1.0,
+                             pulse_freq_khz=30)
 
-        # 1 pulse is the default value
-        self._ltr559.set('PS_N_PULSES', count=1)
+            # 1 pulse is the default value
+            self._ltr559.set('PS_N_PULSES', count=1)
 
-        self._ltr559.set('ALS_CONTROL',
-                         mode=1,
-                         gain=self._gain)
+            self._ltr559.set('ALS_CONTROL',
+                             mode=1,
+                             gain=self._gain)
 
-        self._ltr559.set('PS_CONTROL',
-                         active=True,
-                         saturation_indicator_enable=1)
+            self._ltr559.set('PS_CONTROL',
+                             active=True,
+                             saturation_indicator_enable=1)
 
-        self._ltr559.set('PS_MEAS_RATE', rate_ms=100)
+            self._ltr559.set('PS_MEAS_RATE', rate_ms=100)
 
-        self._ltr559.set('ALS_MEAS_RATE',
-                         integration_time_ms=self._integration_time,
-                         repeat_rate_ms=50)
+            self._ltr559.set('ALS_MEAS_RATE',
+                             integration_time_ms=self._integration_time,
+                             repeat_rate_ms=self._effective_repeat_rate())
 
-        self._ltr559.set('ALS_THRESHOLD',
-                         lower=0x0000,
-                         upper=0xFFFF)
+            self._ltr559.set('ALS_THRESHOLD',
+                             lower=0x0000,
+                             upper=0xFFFF)
 
-        self._ltr559.set('PS_THRESHOLD',
-                         lower=0x0000,
-                         upper=0xFFFF)
+            self._ltr559.set('PS_THRESHOLD',
+                             lower=0x0000,
+                             upper=0xFFFF)
+
+            self._ltr559.set('PS_OFFSET', offset=0)
+
+        if interrupt_pin is not None:
+            self.set_light_tracking()
 
-        self._ltr559.set('PS_OFFSET', offset=0)
+        if auto_range:
+            self.set_auto_range()
 
     def get_part_id(self):
         """Get part number.
@@ -296,6 +418,21 @@ class LTR559:
                          lower=lower,
                          upper=upper)
 
+    def set_light_tracking(self, window=0.1, minimum=8):
+        """Move the light threshold to follow each new reading.
+        For use with an interrupt pin. After every light reading the threshold is set to a
+        window around the new ch0 count, so the next interrupt only fires once the light level
+        has moved by more than the window. Costs a single write per light interrupt.
+        :param window: Half-width of the window as a fraction of ch0, or None to stop tracking
+        :param minimum: Smallest half-width of the window in raw ADC counts
+        """
+        self._light_window = window
+        self._light_window_min = minimum
+
+    def _track_light(self):
+        delta = max(int(self._als0 * self._light_window), self._light_window_min)
+        self.set_light_threshold(max(0, self._als0 - delta), min(ALS_FULL_SCALE, self._als0 + delta))
+
     def set_proximity_threshold(self, lower, upper):
         """Set proximity interrupt threshold.
         Set the upper and lower threshold for the proximity interrupt.
@@ -318,11 +455,14 @@ class LTR559:
     def set_light_integration_time_ms(self, time_ms):
         """Set light integration time in milliseconds.
         This is the measurement time for each individual light sensor measurement,
-        it must be equal to or less than the repeat rate.
+        it must be equal to or less than the repeat rate. The repeat rate is raised to match
+        while the integration time is longer, as the LTR559 would do by itself, so the cached
+        register stays in step with the chip.
         :param time_ms: Time in milliseconds- one of 50, 100, 150, 200, 300, 350, 400
         """
         self._integration_time = time_ms
-        self._ltr559.set('ALS_MEAS_RATE', integration_time_ms=time_ms)
+        self._ltr559.set('ALS_MEAS_RATE', integration_time_ms=time_ms,
+                         repeat_rate_ms=self._effective_repeat_rate())
 
     def set_light_repeat_rate_ms(self, rate_ms=100):
         """Set light measurement repeat rate in milliseconds.
@@ -333,7 +473,15 @@ class LTR559:
         integration time.
         :param rate_ms: Rate in milliseconds- one of 50, 100, 200, 500, 1000 or 2000
         """
-        self._ltr559.set('ALS_MEAS_RATE', set_repeat_rate_ms=rate_ms)
+        self._repeat_rate = rate_ms
+        self._ltr559.set('ALS_MEAS_RATE', repeat_rate_ms=self._effective_repeat_rate())
+
+    def _effective_repeat_rate(self):
+        """Return the requested repeat rate, or the shortest one covering the integration time."""
+        for rate in ALS_REPEAT_RATES:
+            if rate >= self._repeat_rate and rate >= self._integration_time:
+                return rate
+        return ALS_REPEAT_RATES[-1]
 
     def set_interrupt_mode(self, enable_light=True, enable_proximity=True):
         """Set the intterupt mode
@@ -375,12 +523,13 @@ class LTR559:
         :param pulse_freq_khz: LED pulse frequency- one of 30, 40, 50, 60, 70, 80, 90 or 100
         :param num_pulse: Number of LED pulses to be emitted- 1 to 15
         """
-        self._ltr559.set('PS_LED',
-                         current_ma=current_ma,
-                         duty_cycle=duty_cycle,
-                         set_pulse_freq_khz=pulse_freq_khz)
+        with self._ltr559.batch('PS_LED', 'PS_N_PULSES'):
+            self._ltr559.set('PS_LED',
+                             current_ma=current_ma,
+                             duty_cycle=duty_cycle,
+                             pulse_freq_khz=pulse_freq_khz)
 
-        self._ltr559.set('PS_N_PULSES', num_pulses)
+            self._ltr559.set('PS_N_PULSES', count=num_pulses)
 
     def set_light_options(self, active=True, gain=4):
         """Set the mode and gain for the light sensor.
@@ -399,6 +548,63 @@ class LTR559:
                          mode=active,
                          gain=gain)
 
+    def set_auto_range(self, enabled=True, low=0.1, high=0.8, settle_cycles=1):
+        """Enable/disable automatic light gain and integration time ranging.
+        After each light reading the larger of the raw ch0 and ch1 counts is checked against
+        the full scale of 65535. Above `high` the sensor steps to a less sensitive range from
+        `AUTO_RANGES`. Below `low` it steps to a more sensitive one, but only if the reading
+        would still be under `high` afterwards so the two thresholds can't fight each other.
+        The next `settle_cycles` light readings after a change are skipped, since they may
+        have been integrated with the old settings, and the previous lux value is kept.
+        :param enabled: True to enable auto-ranging, False to keep the current gain and integration time
+        :param low: Fraction of full scale below which sensitivity is increased
+        :param high: Fraction of full scale above which sensitivity is reduced
+        :param settle_cycles: Number of light readings to skip after a range change
+        """
+        self._auto_range = enabled
+        self._range_low = int(ALS_FULL_SCALE * low)
+        self._range_high = int(ALS_FULL_SCALE * high)
+        self._settle_cycles = settle_cycles
+        self._settle = 0
+
+        if enabled:
+            # Start from the range closest to the current settings
+            sensitivity = self._gain * self._integration_time
+            self._range_index = min(range(len(AUTO_RANGES)),
+                                    key=lambda x: abs(AUTO_RANGES[x][0] * AUTO_RANGES[x][1] - sensitivity))
+            self._set_range(self._range_index)
+
+    def _set_range(self, index):
+        gain, integration_time = AUTO_RANGES[index]
+        self._range_index = index
+        if gain != self._gain:
+            self.set_light_options(gain=gain)
+        if integration_time != self._integration_time:
+            self.set_light_integration_time_ms(integration_time)
+
+    def _update_range(self):
+        """Step the light range up or down if the last reading is near either end of the scale."""
+        peak = max(self._als0, self._als1)
+        index = self._range_index
+
+        if peak > self._range_high:
+            if index == 0:
+                return
+            index -= 1
+        elif peak < self._range_low:
+            if index == len(AUTO_RANGES) - 1:
+                return
+            gain, integration_time = AUTO_RANGES[index]
+            next_gain, next_integration_time = AUTO_RANGES[index + 1]
+            if peak * next_gain * next_integration_time >= self._range_high * gain * integration_time:
+                return
+            index += 1
+        else:
+            return
+
+        self._set_range(index)
+        self._settle = self._settle_cycles
+
     def update_sensor(self):
         """Update the sensor lux and proximity values.
         Will perform a read of the status register and determine if either an interrupt
@@ -408,29 +614,41 @@ class LTR559:
         Light sensor data is stored in `self._lux` and can be retrieved with `get_lux`.
         Raw light sensor data is also stored in `self._als0` and self._als1` which store
         the ch0 and ch1 values respectively. These can be retrieved with `get_raw_als`.
+        The status, proximity and light data registers are read in a single I2C transaction.
+        With auto-ranging enabled the light gain and integration time may be changed here,
+        see `set_auto_range`.
+        If an interrupt pin was given the sensor is read on the first call and afterwards only
+        while the pin is asserted, otherwise nothing is done and the last values are kept.
+        Reading the status register clears the interrupt.
         """
-        status = self._ltr559.get('ALS_PS_STATUS')
-        ps_int = status.ps_interrupt or status.ps_data
-        als_int = status.als_interrupt or status.als_data
+        if self._interrupt_pin is not None and self._interrupt_primed:
+            if self._interrupt_pin.value != self._interrupt_active:
+                return
+        self._interrupt_primed = True
 
-        if ps_int:
-            self._ps0 = self._ltr559.get('PS_DATA').ch0
+        with self._sample_block:
+            get_field = self._ltr559.get_field
+            ps_int = get_field('ALS_PS_STATUS', 'ps_interrupt') or get_field('ALS_PS_STATUS', 'ps_data')
+            als_int = get_field('ALS_PS_STATUS', 'als_interrupt') or get_field('ALS_PS_STATUS', 'als_data')
 
-        if als_int:
-            als = self._ltr559.get('ALS_DATA')
-            self._als0 = als.ch0
-            self._als1 = als.ch1
+            if ps_int:
+                self._ps0 = get_field('PS_DATA', 'ch0')
+
+            if als_int:
+                self._als0 = get_field('ALS_DATA', 'ch0')
+                self._als1 = get_field('ALS_DATA', 'ch1')
+
+        if als_int and self._light_window is not None:
+            self._track_light()
 
+        if als_int and self._settle > 0:
+            self._settle -= 1
+            return
+
+        if als_int:
             self._ratio = self._als1 * 100 / (self._als1 + self._als0) if self._als0 + self._als1 > 0 else 101
 
-            if self._ratio < 45:
-                ch_idx = 0
-            elif self._ratio < 64:
-                ch_idx = 1
-            elif self._ratio < 85:
-                ch_idx = 2
-            else:
-                ch_idx = 3
+            ch_idx = _ratio_index(self._ratio)
 
             try:
                 self._lux = (self._als0 * self._ch0_c[ch_idx]) - (self._als1 * self._ch1_c[ch_idx])
@@ -440,6 +658,9 @@ class LTR559:
             except ZeroDivisionError:
                 self._lux = 0
 
+            if self._auto_range:
+                self._update_range()
+
     def get_gain(self):
         """Return gain used in lux calculation."""
         return self._gain
@@ -9,6 +9,23 @@ __version__ = '0.0.4'
 
 
 PMS5003_SOF = bytearray(b'\x42\x4d')
+# Payload length following the SOF and length bytes, 13 data words and a checksum
+PMS5003_DATA_LENGTH = 28
+PMS5003_FRAME_LENGTH = 4 + PMS5003_DATA_LENGTH
+# Payload length of the sensor's reply to a mode command, the command, its data and a checksum
+PMS5003_REPLY_LENGTH = 4
+
+# Every byte before the checksum, then the checksum, for `PMS5003Parser._checksum`
+_FRAME_CHECK = ">{}BH".format(PMS5003_FRAME_LENGTH - 2)
+_REPLY_CHECK = ">{}BH".format(4 + PMS5003_REPLY_LENGTH - 2)
+
+PMS5003_CMD_MODE = 0xE1
+PMS5003_CMD_READ = 0xE2
+PMS5003_MODE_PASSIVE = 0x00
+PMS5003_MODE_ACTIVE = 0x01
+
+# Time for the fan to spin up and the readings to stabilise after waking, from the datasheet
+PMS5003_SPIN_UP_TIME = 30.0
 
 
 class ChecksumMismatchError(RuntimeError):
@@ -23,46 +40,66 @@ class SerialTimeoutError(RuntimeError):
     pass
 
 
+# Index of the data word holding each measurement, keyed by particle size in um
+PM_UG_PER_M3 = {1.0: 0, 2.5: 1, 10: 2}
+PM_UG_PER_M3_ATMOS = {1.0: 3, 2.5: 4, None: 5, 10: 5}
+PM_PER_1L_AIR = {0.3: 6, 0.5: 7, 1.0: 8, 2.5: 9, 5: 10, 10: 11}
+
+
 class PMS5003Data():
-    def __init__(self, raw_data):
-        self.raw_data = raw_data
-        self.data = struct.unpack(">HHHHHHHHHHHHHH", raw_data)
-        self.checksum = self.data[13]
+    """A PMS5003 frame payload, decoded lazily.
+    Only a reference to the payload buffer is kept and each field is decoded from it when
+    asked for. An instance created over a bytearray can be reused for later frames with `load`.
+    """
+    __slots__ = ('_buffer', '_offset')
+
+    def __init__(self, raw_data, offset=0):
+        """Wrap a frame payload.
+        :param raw_data: Buffer holding the 28 byte payload, referenced rather than copied
+        :param offset: Index of the payload within raw_data
+        """
+        self._buffer = raw_data
+        self._offset = offset
+
+    def load(self, buffer, offset=0):
+        """Copy a new payload into this instance's own buffer.
+        :param buffer: Buffer holding the 28 byte payload, a memoryview is copied from
+            without an intermediate bytes object
+        :param offset: Index of the payload within buffer
+        """
+        start = self._offset
+        self._buffer[start:start + PMS5003_DATA_LENGTH] = buffer[offset:offset + PMS5003_DATA_LENGTH]
+        return self
+
+    def _word(self, index):
+        offset = self._offset + index * 2
+        return self._buffer[offset] << 8 | self._buffer[offset + 1]
+
+    @property
+    def data(self):
+        """All 14 data words, including the checksum, as a tuple."""
+        return struct.unpack_from(">HHHHHHHHHHHHHH", self._buffer, self._offset)
+
+    @property
+    def checksum(self):
+        return self._word(13)
+
+    @property
+    def raw_data(self):
+        return bytes(self._buffer[self._offset:self._offset + PMS5003_DATA_LENGTH])
 
     def pm_ug_per_m3(self, size, atmospheric_environment=False):
-        if atmospheric_environment:
-            if size == 1.0:
-                return self.data[3]
-            if size == 2.5:
-                return self.data[4]
-            if size is None:
-                return self.data[5]
-
-        else:
-            if size == 1.0:
-                return self.data[0]
-            if size == 2.5:
-                return self.data[1]
-            if size == 10:
-                return self.data[2]
-
-        raise ValueError("Particle size {} measurement not available.".format(size))
+        table = PM_UG_PER_M3_ATMOS if atmospheric_environment else PM_UG_PER_M3
+        try:
+            return self._word(table[size])
+        except KeyError:
+            raise ValueError("Particle size {} measurement not available.".format(size))
 
     def pm_per_1l_air(self, size):
-        if size == 0.3:
-            return self.data[6]
-        if size == 0.5:
-            return self.data[7]
-        if size == 1.0:
-            return self.data[8]
-        if size == 2.5:
-            return self.data[9]
-        if size == 5:
-            return self.data[10]
-        if size == 10:
-            return self.data[11]
-
-        raise ValueError("Particle size {} measurement not available.".format(size))
+        try:
+            return self._word(PM_PER_1L_AIR[size])
+        except KeyError:
+            raise ValueError("Particle size {} measurement not available.".format(size))
 
     def __repr__(self):
         return """
@@ -84,14 +121,203 @@ PM10 ug/m3 (atmos env):                                        {}
         return self.__repr__()
 
 
+class PMS5003Parser():
+    """Incremental PMS5003 frame parser.
+    Bytes are collected in a preallocated receive buffer, either copied in with `feed` or
+    read straight from the UART with `fill`, and parsing resumes where the last call left off.
+    The start of frame is found with `find` over the buffered bytes, and checksums are
+    worked out in place with `struct.unpack_from`. A partial frame is only moved back to
+    the front of the buffer once there's no room left behind it. The short replies the sensor sends to mode commands are recognised and skipped.
+    If a frame has an unexpected length or a bad checksum its start of frame was
+    most likely a coincidence, so the hunt resumes from the byte after it. Any real frame
+    already sitting in the buffer is recovered without waiting for the next one.
+    Counters are kept in `frames`, `checksum_errors`, `resyncs` and `bytes_discarded`, and
+    `mean_latency` is the average time from a start of frame arriving to the frame completing.
+    :param size: Receive buffer size in bytes, must hold at least two frames
+    :param reuse: Return the same PMS5003Data for every frame, overwritten by the next frame,
+        instead of a new one each time
+    """
+    def __init__(self, size=4 * PMS5003_FRAME_LENGTH, reuse=False):
+        self._reuse = reuse
+        self._data = PMS5003Data(bytearray(PMS5003_DATA_LENGTH))
+        self._buffer = bytearray(size)
+        # A slice of this is a small view object, far cheaper than copying by index
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._frame_time = None
+        self.reset_stats()
+
+    def reset(self):
+        self._start = 0
+        self._end = 0
+        self._frame_time = None
+
+    def reset_stats(self):
+        self.frames = 0
+        self.checksum_errors = 0
+        self.resyncs = 0
+        self.bytes_discarded = 0
+        self.latency = 0.0
+
+    @property
+    def mean_latency(self):
+        """Mean time in seconds from a start of frame being received to the frame completing."""
+        if self.frames == 0:
+            return 0.0
+        return self.latency / self.frames
+
+    def feed(self, data):
+        """Parse some bytes.
+        Returns the last frame completed by these bytes as PMS5003Data, or None.
+        :param data: Bytes received from the sensor
+        """
+        result = None
+        offset = 0
+        while offset < len(data):
+            self._make_room()
+            count = min(len(data) - offset, len(self._buffer) - self._end)
+            self._buffer[self._end:self._end + count] = data[offset:offset + count]
+            self._end += count
+            offset += count
+            frame = self._parse()
+            if frame is not None:
+                result = frame
+        return result
+
+    def fill(self, stream):
+        """Read the bytes waiting on a UART into the receive buffer and parse them.
+        Only reads what `in_waiting` reports, so this never blocks. Each read goes straight
+        into the receive buffer through a memoryview slice.
+        Returns the last frame completed by these bytes as PMS5003Data, or None.
+        :param stream: A busio.UART or anything with `in_waiting` and `readinto`
+        """
+        result = None
+        waiting = stream.in_waiting
+        while waiting:
+            self._make_room()
+            count = min(waiting, len(self._buffer) - self._end)
+            self._end += stream.readinto(self._view[self._end:self._end + count]) or 0
+            frame = self._parse()
+            if frame is not None:
+                result = frame
+            waiting = stream.in_waiting
+        return result
+
+    def _make_room(self):
+        """Make sure there's room for at least a frame after the buffered bytes.
+        Nothing is copied if everything has been parsed. Otherwise the partial frame is only
+        moved to the front of the buffer when too close to the end to be completed in place.
+        """
+        start = self._start
+        end = self._end
+        if start == end:
+            self._start = self._end = 0
+        elif start > 0 and len(self._buffer) - end < PMS5003_FRAME_LENGTH:
+            # Copied through a bytes object, an overlapping copy from a view isn't safe
+            self._buffer[0:end - start] = self._buffer[start:end]
+            self._start = 0
+            self._end = end - start
+
+    def _parse(self):
+        result = None
+        buffer = self._buffer
+        end = self._end
+
+        while True:
+            start = buffer.find(PMS5003_SOF, self._start, end)
+            if start < 0:
+                # A trailing first SOF byte may be completed by the next read
+                if end > self._start and buffer[end - 1] == PMS5003_SOF[0]:
+                    start = end - 1
+                else:
+                    start = end
+                self.bytes_discarded += start - self._start
+                self._start = start
+                break
+
+            self.bytes_discarded += start - self._start
+            self._start = start
+            if end - start < 4:
+                self._wait_for_frame()
+                break
+
+            length = buffer[start + 2] << 8 | buffer[start + 3]
+            if length == PMS5003_REPLY_LENGTH:
+                reply_end = start + 4 + PMS5003_REPLY_LENGTH
+                if end < reply_end:
+                    self._wait_for_frame()
+                    break
+                if self._checksum(start, _REPLY_CHECK):
+                    # A command reply, not a measurement, skip it without counting it
+                    self._frame_time = None
+                    self._start = reply_end
+                else:
+                    self._resync(start)
+                continue
+
+            if length != PMS5003_DATA_LENGTH:
+                self._resync(start)
+                continue
+
+            if end - start < PMS5003_FRAME_LENGTH:
+                self._wait_for_frame()
+                break
+
+            frame_end = start + PMS5003_FRAME_LENGTH
+            if not self._checksum(start, _FRAME_CHECK):
+                self.checksum_errors += 1
+                self._resync(start)
+                continue
+
+            now = time.monotonic()
+            self.latency += now - (self._frame_time if self._frame_time is not None else now)
+            self.frames += 1
+            self._frame_time = None
+            if self._reuse:
+                result = self._data.load(self._view, start + 4)
+            else:
+                result = PMS5003Data(buffer[start + 4:frame_end])
+            self._start = frame_end
+
+        return result
+
+    def _checksum(self, start, check):
+        """Check the sum of the bytes from start against the 16 bit checksum that follows them.
+        :param start: Index of the start of frame
+        :param check: _FRAME_CHECK or _REPLY_CHECK, unpacking each byte and then the checksum
+        """
+        values = struct.unpack_from(check, self._buffer, start)
+        # The total includes the checksum itself, so it's twice the checksum if they match
+        return sum(values) == values[-1] << 1
+
+    def _wait_for_frame(self):
+        if self._frame_time is None:
+            self._frame_time = time.monotonic()
+
+    def _resync(self, start):
+        """Give up on the frame at start and hunt again from the byte after its SOF."""
+        self.resyncs += 1
+        self.bytes_discarded += 1
+        self._frame_time = None
+        self._start = start + 1
+
+
 class PMS5003():
-    def __init__(self, baudrate=9600, pin_enable=board.D10, pin_reset=board.D11):
+    def __init__(self, baudrate=9600, pin_enable=board.D10, pin_reset=board.D11, reuse_data=False):
+        """Initialise the PMS5003.
+        :param reuse_data: Return the same PMS5003Data from every read, updated in place,
+            see `PMS5003Parser`
+        """
         self._serial = None
         self._baudrate = baudrate
         self._pin_enable = pin_enable
         self._enable = None
         self._pin_reset = pin_reset
         self._reset = None
+        self._parser = PMS5003Parser(reuse=reuse_data)
+        self._command_buffer = bytearray(7)
+        self._command_buffer[0:2] = PMS5003_SOF
         self.setup()
 
     def setup(self):
@@ -115,49 +341,192 @@ class PMS5003():
         time.sleep(0.1)
         self._reset.value = False
         self._serial.reset_input_buffer()
+        self._parser.reset()
         time.sleep(0.1)
         self._reset.value = True
 
-    def read(self):
-        start = time.time()
-
-        sof_index = 0
-
-        while True:
-            elapsed = time.time() - start
-            if elapsed > 5:
-                raise ReadTimeoutError("PMS5003 Read Timeout: Could not find start of frame")
-
-            sof = self._serial.read(1)
-            if len(sof) == 0:
-                raise SerialTimeoutError("PMS5003 Read Timeout: Failed to read start of frame byte")
-            sof = ord(sof) if type(sof) is bytes else sof
-
-            if sof == PMS5003_SOF[sof_index]:
-                if sof_index == 0:
-                    sof_index = 1
-                elif sof_index == 1:
-                    break
-            else:
-                sof_index = 0
-
-        checksum = sum(PMS5003_SOF)
-
-        data = bytearray(self._serial.read(2))  # Get frame length packet
-        if len(data) != 2:
-            raise SerialTimeoutError("PMS5003 Read Timeout: Could not find length packet")
-        checksum += sum(data)
-        frame_length = struct.unpack(">H", data)[0]
-
-        raw_data = bytearray(self._serial.read(frame_length))
-        if len(raw_data) != frame_length:
-            raise SerialTimeoutError("PMS5003 Read Timeout: Invalid frame length. Got {} bytes, expected {}.".format(len(raw_data), frame_length))
+    def poll(self):
+        """Parse any bytes waiting on the UART without blocking.
+        Returns a PMS5003Data if a complete frame has arrived since the last call,
+        otherwise None. Partial frames are kept and completed on later calls.
+        """
+        return self._parser.fill(self._serial)
+
+    def _command(self, command, data=0x0000):
+        buffer = self._command_buffer
+        buffer[2] = command
+        buffer[3] = data >> 8
+        buffer[4] = data & 0xFF
+        checksum = 0
+        for x in range(5):
+            checksum += buffer[x]
+        buffer[5] = checksum >> 8
+        buffer[6] = checksum & 0xFF
+        self._serial.write(buffer)
+
+    def set_passive_mode(self, passive=True):
+        """Switch between passive (query) and active (streaming) mode.
+        In passive mode the sensor only sends a frame when asked with `request`.
+        The sensor's short reply to the mode command is skipped by the frame parser.
+        :param passive: True for passive mode, False for active mode
+        """
+        self._command(PMS5003_CMD_MODE, PMS5003_MODE_PASSIVE if passive else PMS5003_MODE_ACTIVE)
+
+    def request(self):
+        """Ask for a single frame in passive mode, collect it with `poll`."""
+        self._command(PMS5003_CMD_READ)
+
+    def query(self):
+        """Ask for a single frame in passive mode and wait up to 5 seconds for it."""
+        self.request()
+        return self.read()
+
+    def sleep(self):
+        """Stop the fan and laser by pulling the enable (SET) pin low."""
+        self._enable.value = False
+        self._parser.reset()
+
+    def wake(self):
+        """Start the fan again, readings need `PMS5003_SPIN_UP_TIME` seconds to settle."""
+        self._enable.value = True
 
-        data = PMS5003Data(raw_data)
-        # Don't include the checksum bytes in the checksum calculation
-        checksum += sum(raw_data[:-2])
+    @property
+    def asleep(self):
+        return not self._enable.value
+
+    def get_stats(self):
+        """Return the frame parser counters as a dictionary.
+        frames, checksum_errors, resyncs and bytes_discarded count since setup,
+        mean_latency is in seconds.
+        """
+        parser = self._parser
+        return {
+            "frames": parser.frames,
+            "checksum_errors": parser.checksum_errors,
+            "resyncs": parser.resyncs,
+            "bytes_discarded": parser.bytes_discarded,
+            "mean_latency": parser.mean_latency
+        }
 
-        if checksum != data.checksum:
-            raise ChecksumMismatchError("PMS5003 Checksum Mismatch {} != {}".format(checksum, data.checksum))
+    def read(self):
+        """Wait up to 5 seconds for a complete frame.
+        Frames with a bad checksum are skipped and the stream resynchronised rather than
+        raising ChecksumMismatchError, and a quiet UART no longer raises SerialTimeoutError,
+        so the only error raised is ReadTimeoutError. Those two are kept for compatibility.
+        See `poll` for a non-blocking read, and `get_stats` for the checksum error count.
+        """
+        start = time.monotonic()
 
-        return data
\ No newline at end of file
+        while True:
+            data = self.poll()
+            if data is not None:
+                return data
+
+            if time.monotonic() - start > 5:
+                raise ReadTimeoutError("PMS5003 Read Timeout: Could not read a complete frame")
+
+            # A frame takes ~35ms at 9600 baud, don't spin while it arrives
+            time.sleep(0.01)
+
+
+class PMS5003Scheduler():
+    """Duty cycle a PMS5003 in passive mode.
+    The sensor is kept asleep, woken `spin_up` seconds before each measurement window, asked
+    for `samples` frames and put back to sleep. Windows start every `period` seconds.
+    Call `update` from the main loop, it never blocks. If the sensor stops answering, the
+    window is given up after `retries` repeated requests and the sensor put back to sleep,
+    these are counted in `missed`.
+    :param sensor: A PMS5003
+    :param period: Seconds from the start of one measurement window to the next
+    :param spin_up: Seconds to run the fan before measuring
+    :param samples: Number of frames to take in each window
+    :param timeout: Seconds to wait for a requested frame before asking again
+    :param retries: Number of times to ask again before giving up on a window
+    :param clock: Function returning the current time in seconds
+    """
+    SLEEPING = 0
+    SPINNING_UP = 1
+    MEASURING = 2
+
+    def __init__(self, sensor, period=300.0, spin_up=PMS5003_SPIN_UP_TIME, samples=1, timeout=5.0,
+                 retries=3, clock=time.monotonic):
+        if period <= spin_up:
+            raise ValueError("Period must be longer than the spin up time")
+        self.sensor = sensor
+        self.period = period
+        self.spin_up = spin_up
+        self.samples = samples
+        self.timeout = timeout
+        self.retries = retries
+        self.missed = 0
+        self._clock = clock
+        self.state = self.SLEEPING
+        self._wake_time = clock()
+        self._ready_time = 0
+        self._request_time = 0
+        self._count = 0
+        self._retry = 0
+        sensor.sleep()
+
+    @property
+    def next_update(self):
+        """Time at which `update` next has something to do."""
+        if self.state == self.SLEEPING:
+            return self._wake_time
+        if self.state == self.SPINNING_UP:
+            return self._ready_time
+        return self._clock()
+
+    def update(self):
+        """Advance the schedule.
+        Returns a PMS5003Data when a requested frame arrives, otherwise None.
+        """
+        now = self._clock()
+        sensor = self.sensor
+
+        if self.state == self.SLEEPING:
+            if now >= self._wake_time:
+                sensor.wake()
+                self._ready_time = now + self.spin_up
+                self.state = self.SPINNING_UP
+
+        elif self.state == self.SPINNING_UP:
+            if now >= self._ready_time:
+                # Drop anything sent while the fan was spinning up, the sensor may have been
+                # too busy booting to take a mode command when it was woken so send it now
+                sensor.poll()
+                sensor.set_passive_mode()
+                sensor.request()
+                self._request_time = now
+                self._count = 0
+                self._retry = 0
+                self.state = self.MEASURING
+
+        elif self.state == self.MEASURING:
+            data = sensor.poll()
+            if data is not None:
+                self._count += 1
+                if self._count < self.samples:
+                    sensor.request()
+                    self._request_time = now
+                    self._retry = 0
+                else:
+                    self._finish()
+                return data
+
+            if now - self._request_time > self.timeout:
+                if self._retry < self.retries:
+                    sensor.request()
+                    self._request_time = now
+                    self._retry += 1
+                else:
+                    self.missed += 1
+                    self._finish()
+
+        return None
+
+    def _finish(self):
+        """Put the sensor to sleep until the next window."""
+        self.sensor.sleep()
+        self._wake_time = self._ready_time - self.spin_up + self.period
+        self.state = self.SLEEPING
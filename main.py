@@ -1,9 +1,11 @@
 import board 
+import asyncio
 from adafruit_display_text import label
 import terminalio
 
 from led_status import LedStatus
-from sensors import Sensors
+from sensors import Sensors, SensorData, Deadband
+from rolling import Statistics
 from network_service import NetworkService
 from display import Display
 from plotter import Plotter
@@ -11,7 +13,17 @@ from plotter import Plotter
 led = LedStatus()
 lcd = Display(backlight_control=True, baudrate=8000000)
 nws = NetworkService()
-sns = Sensors(update_timeout=30.0, debug=True)
+# The DAQI bands for PM2.5 are defined on the 24 hour mean
+stats = Statistics(SensorData.FIELDS, channels=('pm2_5',))
+# Only pass on readings that moved enough to matter, or every 10 minutes regardless
+deadbands = {
+    'temperature': Deadband(absolute=0.1, heartbeat=600),
+    'humidity': Deadband(absolute=0.5, heartbeat=600),
+    'pressure': Deadband(absolute=0.5, heartbeat=600),
+    'pm2_5': Deadband(absolute=1.0, heartbeat=600),
+    'light': Deadband(relative=0.05, heartbeat=600)
+}
+sns = Sensors(update_timeout=30.0, debug=True, statistics=stats, deadbands=deadbands)
 
 plotter = Plotter(lcd,
                   style="lines", #"dots"
@@ -33,10 +45,11 @@ plotter.channel_colidx = [0xffff00, 0x00ffff, 0xff0080]
 
 @sns.on_update
 def on_update(readings):
-    led.show_air_quality(int(readings.pm2_5))
+    if readings.changed & readings.mask('pm2_5'):
+        pm2_5 = stats.mean('pm2_5', '24h')
+        led.show_air_quality(int(readings.pm2_5 if pm2_5 is None else pm2_5))
     lcd.update(readings)
     # plotter.data_add((readings.temperature, readings.pm2_5, readings.humidity))
     # nw.connect_and_send(readings)
 
-while True:
-    sns.run()
\ No newline at end of file
+asyncio.run(sns.run_async())
@@ -0,0 +1,103 @@
+import time
+
+import adafruit_logging as logging
+
+NO_SLEEP = 0
+LIGHT_SLEEP = 1
+DEEP_SLEEP = 2
+
+
+def plan_sleep(now, due, min_sleep=0.05, deep_sleep_threshold=None):
+    """Decide how to wait until the next event.
+    Returns a tuple of (mode, seconds) where mode is NO_SLEEP, LIGHT_SLEEP or DEEP_SLEEP.
+    :param now: Current time in seconds
+    :param due: Time in seconds of the next event
+    :param min_sleep: Waits shorter than this are not worth sleeping for
+    :param deep_sleep_threshold: Waits at least this long use deep sleep, None to never deep sleep
+    """
+    delay = due - now
+    if delay < min_sleep:
+        return NO_SLEEP, max(0, delay)
+    if deep_sleep_threshold is not None and delay >= deep_sleep_threshold:
+        return DEEP_SLEEP, delay
+    return LIGHT_SLEEP, delay
+
+
+class PowerManager:
+    """Low power main loop for Sensors.
+    Works out the next event across the sensors and anything registered with `add_event`,
+    such as display refreshes or network publishes, and sleeps until then with CircuitPython
+    `alarm` time alarms plus any pin alarms given. Long waits can use deep sleep, in which case
+    the sensor readings, schedule, statistics and as much history and downsampled history as
+    fits are kept in `alarm.sleep_memory` and restored on wake.
+    Times come from the sensors' clock, so the decision logic in `plan` can be tested on a
+    host by giving the Sensors a fake one.
+    """
+    def __init__(
+        self,
+        sensors,
+        min_sleep=0.05,
+        deep_sleep_threshold=None,
+        pin_alarms=()
+    ):
+        """
+        :param sensors: The Sensors to run
+        :param min_sleep: Waits shorter than this are spent running instead of sleeping
+        :param deep_sleep_threshold: Waits at least this long use deep sleep, None to only light sleep.
+            Deep sleep resets the board, so only use it if nothing else has to keep running.
+        :param pin_alarms: alarm.pin.PinAlarm objects that should also wake the board
+        """
+        self.logger = logging.getLogger('enviro+')
+        self.sensors = sensors
+        self.min_sleep = min_sleep
+        self.deep_sleep_threshold = deep_sleep_threshold
+        self.pin_alarms = tuple(pin_alarms)
+        self._events = []
+
+    def add_event(self, due):
+        """Register another source of events.
+        :param due: Function returning the time at which it next needs to run, on the sensors' clock
+        """
+        self._events.append(due)
+
+    def next_event(self):
+        due = self.sensors.next_event()
+        for event in self._events:
+            due = min(due, event())
+        return due
+
+    def plan(self):
+        """Return (mode, seconds) for how to wait until the next event, see `plan_sleep`."""
+        return plan_sleep(self.sensors.clock(), self.next_event(), self.min_sleep, self.deep_sleep_threshold)
+
+    def restore(self):
+        """Restore the sensor state if the board has just woken from deep sleep.
+        Returns True if state was restored.
+        """
+        import alarm
+
+        if alarm.wake_alarm is None:
+            return False
+        restored = self.sensors.restore_state(alarm.sleep_memory)
+        if restored:
+            self.logger.debug("Restored sensor state after deep sleep")
+        return restored
+
+    def sleep(self, mode, delay):
+        if mode == NO_SLEEP:
+            return
+
+        import alarm
+
+        # The alarm always runs on time.monotonic(), the saved state on the sensors' clock
+        time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + delay)
+        if mode == DEEP_SLEEP:
+            self.sensors.save_state(alarm.sleep_memory, self.sensors.clock() + delay)
+            alarm.exit_and_deep_sleep_until_alarms(time_alarm, *self.pin_alarms)
+        else:
+            alarm.light_sleep_until_alarms(time_alarm, *self.pin_alarms)
+
+    def run(self):
+        """Run the sensors, then sleep until the next event. Call in a loop."""
+        self.sensors.run()
+        self.sleep(*self.plan())
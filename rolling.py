@@ -0,0 +1,354 @@
+import math
+import struct
+from array import array
+
+
+class RunningStats:
+    """Count, mean, variance, minimum and maximum of every value added, in O(1) per value.
+    Variance uses Welford's method so it stays accurate over long runs.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.minimum = None
+        self.maximum = None
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def _pack(self, base_time):
+        return struct.pack("<Lffff", self.count, self.mean, self._m2,
+                           self.minimum if self.count else 0.0, self.maximum if self.count else 0.0)
+
+    def _unpack(self, data, position, base_time):
+        self.count, self.mean, self._m2, self.minimum, self.maximum = struct.unpack_from("<Lffff", data, position)
+        if self.count == 0:
+            self.minimum = self.maximum = None
+        return position + struct.calcsize("<Lffff")
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+
+class EMA:
+    """Exponential moving average that allows for irregular sample times.
+    :param time_constant: Seconds for the average to move ~63% of the way to a new level
+    """
+    def __init__(self, time_constant):
+        self.time_constant = time_constant
+        self.value = None
+        self._time = None
+
+    def add(self, value, timestamp):
+        if self.value is None:
+            self.value = value
+        else:
+            alpha = 1.0 - math.exp(-(timestamp - self._time) / self.time_constant)
+            self.value += (value - self.value) * alpha
+        self._time = timestamp
+        return self.value
+
+    def _pack(self, base_time):
+        if self.value is None:
+            return struct.pack("<Bff", 0, 0.0, 0.0)
+        # Relative, so the time keeps its precision as a float
+        return struct.pack("<Bff", 1, self.value, self._time - base_time)
+
+    def _unpack(self, data, position, base_time):
+        valid, value, timestamp = struct.unpack_from("<Bff", data, position)
+        self.value = value if valid else None
+        self._time = base_time + timestamp if valid else None
+        return position + struct.calcsize("<Bff")
+
+
+class SlidingWindow:
+    """Mean, minimum and maximum over the last `seconds` seconds, in O(1) per value.
+    The window is split into `buckets` time slots, each keeping the minimum, maximum, sum and
+    count of its values, so memory is fixed however often values arrive. Sliding minimum and
+    maximum are kept with monotonic queues of buckets. Results cover the window ending at the
+    last value added and the window edge moves in steps of one bucket.
+    """
+    def __init__(self, seconds, buckets=24):
+        self.seconds = seconds
+        self.buckets = buckets
+        self._width = seconds / buckets
+
+        # Ring of closed buckets, addressed by bucket sequence number modulo buckets
+        self._starts = array('l', [0] * buckets)
+        self._mins = array('f', [0.0] * buckets)
+        self._maxs = array('f', [0.0] * buckets)
+        self._sums = array('f', [0.0] * buckets)
+        self._counts = array('L', [0] * buckets)
+
+        # Monotonic queues of bucket sequence numbers, positions modulo buckets
+        self._min_queue = array('L', [0] * buckets)
+        self._max_queue = array('L', [0] * buckets)
+        self.reset()
+
+    def reset(self):
+        self._first = 0
+        self._next = 0
+        self._min_head = self._min_tail = 0
+        self._max_head = self._max_tail = 0
+
+        self._sum = 0.0
+        self._count = 0
+
+        # The bucket still being filled
+        self._bucket = None
+        self._bucket_min = 0.0
+        self._bucket_max = 0.0
+        self._bucket_sum = 0.0
+        self._bucket_count = 0
+
+    def add(self, value, timestamp):
+        bucket = int(timestamp // self._width)
+        if bucket != self._bucket:
+            if self._bucket is not None:
+                self._close()
+            self._bucket = bucket
+            self._bucket_min = value
+            self._bucket_max = value
+            self._bucket_sum = 0.0
+            self._bucket_count = 0
+            self._expire(bucket - self.buckets)
+
+        self._bucket_min = min(self._bucket_min, value)
+        self._bucket_max = max(self._bucket_max, value)
+        self._bucket_sum += value
+        self._bucket_count += 1
+
+    def _close(self):
+        seq = self._next
+        slot = seq % self.buckets
+        if seq - self._first == self.buckets:
+            self._evict()
+        self._starts[slot] = self._bucket
+        self._mins[slot] = self._bucket_min
+        self._maxs[slot] = self._bucket_max
+        self._sums[slot] = self._bucket_sum
+        self._counts[slot] = self._bucket_count
+        self._sum += self._bucket_sum
+        self._count += self._bucket_count
+        self._next += 1
+
+        size = self.buckets
+        while self._min_tail > self._min_head and \
+                self._mins[self._min_queue[(self._min_tail - 1) % size] % size] >= self._bucket_min:
+            self._min_tail -= 1
+        self._min_queue[self._min_tail % size] = seq
+        self._min_tail += 1
+
+        while self._max_tail > self._max_head and \
+                self._maxs[self._max_queue[(self._max_tail - 1) % size] % size] <= self._bucket_max:
+            self._max_tail -= 1
+        self._max_queue[self._max_tail % size] = seq
+        self._max_tail += 1
+
+    def _expire(self, oldest):
+        """Drop closed buckets that started at or before bucket number oldest."""
+        while self._first < self._next and self._starts[self._first % self.buckets] <= oldest:
+            self._evict()
+
+    def _evict(self):
+        seq = self._first
+        slot = seq % self.buckets
+        self._sum -= self._sums[slot]
+        self._count -= self._counts[slot]
+        if self._min_tail > self._min_head and self._min_queue[self._min_head % self.buckets] == seq:
+            self._min_head += 1
+        if self._max_tail > self._max_head and self._max_queue[self._max_head % self.buckets] == seq:
+            self._max_head += 1
+        self._first += 1
+        if self._first == self._next:
+            # Nothing left, start the sum again rather than carry rounding errors forward
+            self._sum = 0.0
+
+    def _pack(self, base_time):
+        """The open bucket then every closed one, oldest first, from which `_unpack` rebuilds the rest."""
+        data = [struct.pack("<BlfffLH", self._bucket is not None,
+                            self._bucket if self._bucket is not None else 0, self._bucket_min,
+                            self._bucket_max, self._bucket_sum, self._bucket_count, self._next - self._first)]
+        for seq in range(self._first, self._next):
+            slot = seq % self.buckets
+            data.append(struct.pack("<lfffL", self._starts[slot], self._mins[slot], self._maxs[slot],
+                                    self._sums[slot], self._counts[slot]))
+        return b"".join(data)
+
+    def _unpack(self, data, position, base_time):
+        self.reset()
+        valid, bucket, low, high, total, count, closed = struct.unpack_from("<BlfffLH", data, position)
+        position += struct.calcsize("<BlfffLH")
+        for _ in range(closed):
+            (self._bucket, self._bucket_min, self._bucket_max, self._bucket_sum,
+             self._bucket_count) = struct.unpack_from("<lfffL", data, position)
+            self._close()
+            position += struct.calcsize("<lfffL")
+        self._bucket = bucket if valid else None
+        self._bucket_min = low
+        self._bucket_max = high
+        self._bucket_sum = total
+        self._bucket_count = count
+        return position
+
+    @property
+    def count(self):
+        return self._count + self._bucket_count
+
+    @property
+    def mean(self):
+        count = self.count
+        if count == 0:
+            return None
+        return (self._sum + self._bucket_sum) / count
+
+    @property
+    def minimum(self):
+        if self._bucket_count == 0:
+            return None
+        value = self._bucket_min
+        if self._min_tail > self._min_head:
+            value = min(value, self._mins[self._min_queue[self._min_head % self.buckets] % self.buckets])
+        return value
+
+    @property
+    def maximum(self):
+        if self._bucket_count == 0:
+            return None
+        value = self._bucket_max
+        if self._max_tail > self._max_head:
+            value = max(value, self._maxs[self._max_queue[self._max_head % self.buckets] % self.buckets])
+        return value
+
+
+class ChannelStats:
+    """Every statistic kept for one channel."""
+    def __init__(self, windows, buckets, ema_time_constant):
+        self.running = RunningStats()
+        self.ema = EMA(ema_time_constant)
+        self.windows = {}
+        for name, seconds in windows.items():
+            self.windows[name] = SlidingWindow(seconds, buckets)
+
+    def add(self, value, timestamp):
+        self.running.add(value)
+        self.ema.add(value, timestamp)
+        for window in self.windows.values():
+            window.add(value, timestamp)
+
+    def _pack(self, base_time):
+        data = [self.running._pack(base_time), self.ema._pack(base_time)]
+        for window in self.windows.values():
+            data.append(window._pack(base_time))
+        return b"".join(data)
+
+    def _unpack(self, data, position, base_time):
+        position = self.running._unpack(data, position, base_time)
+        position = self.ema._unpack(data, position, base_time)
+        for window in self.windows.values():
+            position = window._unpack(data, position, base_time)
+        return position
+
+
+class Statistics:
+    """Streaming statistics for a set of SensorData channels.
+    Fed with `update` on each Sensors update, only fields refreshed since the previous update
+    are counted so a sensor sampled less often than the update rate isn't counted twice.
+    Use `save` and `restore` to keep the statistics across a deep sleep.
+    :param fields: Names of all channels in order, such as SensorData.FIELDS
+    :param channels: Names of the channels to keep statistics for, all of them if None
+    :param windows: Dictionary of sliding window lengths in seconds keyed by a name, such as '1h'
+    :param buckets: Number of time slots each sliding window is split into
+    :param ema_time_constant: Time constant of the exponential moving average in seconds
+    """
+    def __init__(self, fields, channels=None, windows=None, buckets=24, ema_time_constant=300.0):
+        if windows is None:
+            windows = {'1h': 3600, '24h': 86400}
+        self.fields = fields
+        self.channels = {}
+        for name in channels if channels is not None else fields:
+            self.channels[name] = ChannelStats(windows, buckets, ema_time_constant)
+        self._indexes = [(fields.index(name), stats) for name, stats in self.channels.items()]
+        # Added to every time, so windows restored after a deep sleep keep their bucket numbers
+        self._offset = 0
+
+    def update(self, readings, timestamp):
+        """Add the refreshed fields of a SensorData."""
+        timestamp += self._offset
+        for index, stats in self._indexes:
+            if readings.refreshed & (1 << index):
+                stats.add(readings.values[index], timestamp)
+
+    def save(self, memory, offset, base_time, size=None):
+        """Save every statistic to memory, such as alarm.sleep_memory, if they all fit.
+        Otherwise a single zero byte is saved and `restore` starts afresh.
+        Returns the number of bytes used.
+        :param memory: Writable buffer
+        :param offset: Index within memory to save at
+        :param base_time: Time at which the board is due to wake, see `restore`
+        :param size: Bytes available from offset, the rest of memory if None
+        """
+        if size is None:
+            size = len(memory) - offset
+        if size < 1:
+            return 0
+        # Saved and the wake time on the window time line, then each channel in turn
+        wake_time = int(base_time) + self._offset
+        data = [struct.pack("<Bl", 1, wake_time)]
+        for stats in self.channels.values():
+            data.append(stats._pack(wake_time))
+        data = b"".join(data)
+        if len(data) > size:
+            data = bytes(1)
+        memory[offset:offset + len(data)] = data
+        return len(data)
+
+    def restore(self, memory, offset, base_time):
+        """Restore the statistics saved with `save`, replacing any held.
+        Window times carry on from the base_time given to `save`. Returns the number of bytes read.
+        :param base_time: Current time, taken as the wake time given to `save`
+        """
+        if len(memory) - offset < 1:
+            return 0
+        if memory[offset] == 0:
+            return 1
+        data = bytes(memory[offset:])
+        wake_time = struct.unpack_from("<Bl", data, 0)[1]
+        self._offset = wake_time - int(base_time)
+        position = struct.calcsize("<Bl")
+        for stats in self.channels.values():
+            position = stats._unpack(data, position, wake_time)
+        return position
+
+    def __getitem__(self, channel):
+        return self.channels[channel]
+
+    def mean(self, channel, window):
+        return self.channels[channel].windows[window].mean
+
+    def minimum(self, channel, window):
+        return self.channels[channel].windows[window].minimum
+
+    def maximum(self, channel, window):
+        return self.channels[channel].windows[window].maximum
+
+    def ema(self, channel):
+        return self.channels[channel].ema.value
@@ -1,13 +1,17 @@
-import board
 import time
-from digitalio import DigitalInOut, Direction
-from analogio import AnalogIn
+import struct
+import asyncio
+from array import array
 
 import adafruit_logging as logging
-from adafruit_bme280 import Adafruit_BME280_I2C
-from adafruit_pm25 import PM25_UART
+try:
+    from adafruit_bme280.basic import Adafruit_BME280_I2C
+except ImportError:
+    # adafruit_bme280 before 2.6 was a single module
+    from adafruit_bme280 import Adafruit_BME280_I2C
 from adafruit_sgp30 import Adafruit_SGP30
 from ltr559 import LTR559
+from history import History
 
 WAITING = 0
 READING = 1
@@ -15,19 +19,111 @@ UPDATED = 2
 CALIBRATING = 3
 ERROR = 4
 
+# Seconds between samples for sensors that shouldn't follow the update timeout
+DEFAULT_SAMPLE_PERIODS = {
+    'sgp30': 1.0,  # The SGP30 baseline algorithm expects to be read at 1Hz
+    'pms5003': 1.0,  # The PMS5003 streams a frame roughly every second
+    'battery': 60.0
+}
+
+SENSOR_NAMES = ('bme280', 'sgp30', 'pms5003', 'ltr559', 'battery')
+
+def _field(index, kind=float):
+    def getter(self):
+        return kind(self.values[index])
+
+    def setter(self, value):
+        self.set(index, value)
+
+    return property(getter, setter)
+
+
+class Deadband():
+    """How much a reading has to move before callbacks hear about it.
+    A reading counts as changed when it moves from the last value passed to the callbacks
+    by more than the larger of absolute and relative times that value, or when it hasn't
+    been passed on for heartbeat seconds.
+    """
+    __slots__ = ('absolute', 'relative', 'heartbeat')
+
+    def __init__(self, absolute=0.0, relative=0.0, heartbeat=None):
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat
+
+
 class SensorData():
-    def __init__(self):
-        self.temperature = 0.0
-        self.humidity = 0.0
-        self.pressure = 0.0
-        self.altitiude = 0.0
-        self.pm1 = 0.0
-        self.pm2_5 = 0.0
-        self.pm10 = 0.0
-        self.eco2 = 0
-        self.tvoc = 0
-        self.light = 0.0
-        self.battery_voltage = 0
+    """Latest value of every reading, updated in place.
+    Values live in a preallocated array and each field records when it was last set and
+    whether it has ever been set. `sequence` counts updates published by Sensors and
+    `refreshed` is a bitmask, bit n for FIELDS[n], of the fields set since the previous update,
+    and `changed` the fields that moved outside their deadband, see `Sensors`.
+    """
+    FIELDS = ('temperature', 'humidity', 'pressure', 'altitiude', 'pm1', 'pm2_5', 'pm10',
+              'eco2', 'tvoc', 'light', 'battery_voltage')
+
+    __slots__ = ('values', 'timestamps', 'valid', 'sequence', 'refreshed', 'changed', '_pending', '_clock')
+
+    temperature = _field(0)
+    humidity = _field(1)
+    pressure = _field(2)
+    altitiude = _field(3)
+    pm1 = _field(4)
+    pm2_5 = _field(5)
+    pm10 = _field(6)
+    eco2 = _field(7, int)
+    tvoc = _field(8, int)
+    light = _field(9)
+    battery_voltage = _field(10, int)
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: Function returning the current time in seconds, to timestamp fields with
+        """
+        self.values = array('f', [0.0] * len(self.FIELDS))
+        self.timestamps = array('f', [0.0] * len(self.FIELDS))
+        self.valid = 0
+        self.sequence = 0
+        self.refreshed = 0
+        self.changed = 0
+        self._pending = 0
+        self._clock = clock
+
+    @classmethod
+    def mask(cls, *names):
+        """Return the bitmask for the named fields, for testing `refreshed` or `changed`."""
+        mask = 0
+        for name in names:
+            mask |= 1 << cls.FIELDS.index(name)
+        return mask
+
+    def set(self, index, value, timestamp=None):
+        """Set the field FIELDS[index], timestamped with the clock unless given."""
+        self.values[index] = value
+        self.timestamps[index] = self._clock() if timestamp is None else timestamp
+        self.valid |= 1 << index
+        self._pending |= 1 << index
+
+    def is_valid(self, index):
+        return bool(self.valid & (1 << index))
+
+    def publish(self):
+        """Start a new update, moving the fields set since the last one into `refreshed`."""
+        self.sequence += 1
+        self.refreshed = self._pending
+        self._pending = 0
+
+    def copy_into(self, other):
+        """Copy every field, timestamp and flag into another SensorData without allocating."""
+        for x in range(len(self.values)):
+            other.values[x] = self.values[x]
+            other.timestamps[x] = self.timestamps[x]
+        other.valid = self.valid
+        other.sequence = self.sequence
+        other.refreshed = self.refreshed
+        other.changed = self.changed
+        other._pending = self._pending
+        return other
 
     def __repr__(self):
         fmt = """
@@ -58,28 +154,95 @@ Battery:     {bat:d} mV
 
     __str__ = __repr__
 
+
+# Magic number, the valid mask and every reading with its timestamp, the next sample time
+# of each sensor, the last update and calibration times, and the mask, values and times
+# of the readings last passed to the callbacks for deadbands
+STATE_MAGIC = 0x4550
+STATE_FORMAT = "<HH{0}f{0}f{1}fffH{0}f{0}f".format(len(SensorData.FIELDS), len(SENSOR_NAMES))
+
+
 class Sensors:
     def __init__(
         self,
         update_timeout=2.0,
-        debug=False
+        debug=False,
+        i2c=None,
+        sample_periods=None,
+        history_size=120,
+        statistics=None,
+        downsampler=None,
+        deadbands=None,
+        battery=None,
+        pms5003=None,
+        clock=time.monotonic
     ):
-        self.current_time = time.monotonic()
+        """
+        :param update_timeout: Seconds between updates to the on_update callbacks
+        :param i2c: Bus to use instead of board.I2C(), such as an i2cdevice.simulator.SimulatedI2C
+        :param sample_periods: Dictionary of seconds between samples keyed by sensor name, one of
+            bme280, sgp30, pms5003, ltr559 or battery. Sensors not given use DEFAULT_SAMPLE_PERIODS
+            or otherwise update_timeout. Readings hold the latest sample of each sensor.
+        :param history_size: Number of updates kept in `history` for every reading, 0 for none
+        :param statistics: A rolling.Statistics to feed with each update
+        :param downsampler: A history.Downsampler to feed with each update, for long term history
+        :param deadbands: Dictionary of Deadband keyed by SensorData field name. Fields without
+            one count as changed whenever they are refreshed. Callbacks are skipped for updates
+            where nothing changed, and `readings.changed` tells them which fields did.
+        :param battery: Analog input to read the battery voltage from, with `value` and
+            `reference_voltage` like analogio.AnalogIn, AnalogIn(board.VOLTAGE_MONITOR) if None
+        :param pms5003: A pms5003.PMS5003 in active mode, or a pms5003.PMS5003Scheduler duty
+            cycling one, None for no particulate readings. Either is polled without blocking.
+            With a scheduler nothing is polled while the sensor sleeps, and `next_event` waits
+            for its `next_update`, so a PowerManager sleeps through to the next window.
+            Give a scheduler the same clock.
+        :param clock: Function returning the current time in seconds, used for every timestamp
+            and schedule, including `next_event` and the times in `save_state`
+        """
+        self.clock = clock
+        self.current_time = clock()
         self.logger = logging.getLogger('enviro+')
         self.state = WAITING
         self.prev_state = self.state
-        self.readings = SensorData()
+        self.readings = SensorData(clock)
+        # Shared by everything that needs past readings, appended at each update
+        self.history = History(SensorData.FIELDS, history_size) if history_size else None
+        self.statistics = statistics
+        self.downsampler = downsampler
+        self._deadbands = [None] * len(SensorData.FIELDS)
+        if deadbands:
+            for name, deadband in deadbands.items():
+                self._deadbands[SensorData.FIELDS.index(name)] = deadband
+        # Last value passed to the callbacks per field, `_notified_mask` marks the ones set
+        self._notified = array('f', [0.0] * len(SensorData.FIELDS))
+        self._notified_time = array('f', [0.0] * len(SensorData.FIELDS))
+        self._notified_mask = 0
         self.update_timeout = update_timeout
         self.calibration_timeout = 30.0 * 60
         self.last_update_time = 0
         self.last_calibration_time = 0
         self.debug = debug
+        self._i2c = i2c
+        self._battery = battery
+        self._pms5003 = pms5003
 
         # callbacks
         self._on_update_callbacks = []
 
         self._init_sensors()
 
+        self._reads = self._sensor_reads()
+        self.sample_periods = {}
+        self._next_sample = {}
+        for name in self._reads:
+            period = update_timeout
+            if sample_periods and name in sample_periods:
+                period = sample_periods[name]
+            elif name in DEFAULT_SAMPLE_PERIODS:
+                period = DEFAULT_SAMPLE_PERIODS[name]
+            self.sample_periods[name] = period
+            self._next_sample[name] = 0
+
     def _scan_bus(self, i2c):
         while not i2c.try_lock():
             pass
@@ -91,8 +254,11 @@ class Sensors:
         i2c.unlock()
 
     def _init_sensors(self):
-        i2c = board.I2C()
-        
+        i2c = self._i2c
+        if i2c is None:
+            import board
+            i2c = board.I2C()
+
         if self.debug:
             self._scan_bus(i2c)
 
@@ -107,29 +273,178 @@ class Sensors:
             self.logger.warning("SGP30 not found")
             self.sgp30 = None
 
-        # self._pm_reset = DigitalInOut(board.D6)
-        # self._pm_enable = DigitalInOut(board.D5)
-        # self._pm_enable.direction = Direction.OUTPUT
-        # self._pm_enable.value = True
-
-        # uart = board.UART()
-        # uart.baudrate = 9600
-        # uart.timeout = 4
+        self.pms5003 = self._pms5003
+        # A PMS5003Scheduler is told apart by its schedule, the sensor itself has none
+        self._pms5003_scheduled = hasattr(self.pms5003, 'next_update')
 
-        # self.pms5003 = PM25_UART(uart, self._pm_reset)
-        self.pms5003 = None
-        
-        self.ltr559 = LTR559(i2c_dev=i2c)
+        self.ltr559 = LTR559(i2c_dev=i2c, auto_range=True)
 
-        self.battery = AnalogIn(board.VOLTAGE_MONITOR)
+        self.battery = self._battery
+        if self.battery is None:
+            import board
+            from analogio import AnalogIn
+            self.battery = AnalogIn(board.VOLTAGE_MONITOR)
         self.divider_ratio = 2
 
     def run(self):
-        self.current_time = time.monotonic()
+        self.current_time = self.clock()
         self._update_values()
         self._notify_callbacks()
         # self._update_display()
 
+    async def run_async(self):
+        """Run the sensors as cooperative asyncio tasks, never returns.
+        Each sensor is read by its own task which sleeps for its sample period between
+        samples, so the CPU is free for other tasks in between. Callbacks are notified every
+        `update_timeout` seconds and may be coroutine functions, in which case they are awaited.
+        Use instead of calling `run` in a loop.
+        """
+        tasks = [asyncio.create_task(self._sensor_task(read, self.sample_periods[name]))
+                 for name, read in self._reads.items()]
+        tasks.append(asyncio.create_task(self._calibration_task()))
+        tasks.append(asyncio.create_task(self._publish_task()))
+        await asyncio.gather(*tasks)
+
+    def _sensor_reads(self):
+        reads = {
+            'bme280': self._read_bme280,
+            'ltr559': self._read_ltr559,
+            'battery': self._read_battery
+        }
+        if self.pms5003:
+            reads['pms5003'] = self._read_pms5003
+        if self.sgp30:
+            reads['sgp30'] = self._read_sgp30
+        return reads
+
+    def _sample_due(self):
+        """Read each sensor whose sample period has elapsed."""
+        for name, read in self._reads.items():
+            if self.current_time >= self._next_sample[name]:
+                # Set first so a read can put its next sample off further
+                self._next_sample[name] = self.current_time + self.sample_periods[name]
+                read()
+
+    async def _sensor_task(self, read, period):
+        while True:
+            read()
+            await asyncio.sleep(period)
+
+    async def _calibration_task(self):
+        while True:
+            await asyncio.sleep(self.calibration_timeout)
+            self.current_time = self.clock()
+            self._calibrate()
+
+    async def _publish_task(self):
+        while True:
+            # Let the sensor tasks take their first samples before publishing
+            await asyncio.sleep(self.update_timeout)
+            self.current_time = self.clock()
+            self.last_update_time = self.current_time
+            self._publish()
+            if self.debug:
+                print(self.readings)
+            if not self.readings.changed:
+                continue
+            for on_update_callback in self._on_update_callbacks:
+                result = on_update_callback(self.readings)
+                if result is not None:
+                    await result
+
+    def next_event(self):
+        """Return the time on the clock at which `run` next has work to do.
+        Between events the caller is free to sleep.
+        """
+        if self.state != WAITING:
+            return self.current_time
+        due = min(self.last_update_time + self.update_timeout,
+                  self.last_calibration_time + self.calibration_timeout)
+        for name in self._reads:
+            due = min(due, self._next_sample[name])
+        return due
+
+    def save_state(self, memory, wake_time, offset=0):
+        """Save readings and schedule to memory, such as alarm.sleep_memory, before a deep sleep.
+        The clock starts again after a deep sleep, so times are stored relative to wake_time.
+        The statistics follow the state if they fit, then as much recent history as fits, and
+        the downsampler keeps as many of its buckets as fit in whatever room is left after that.
+        :param memory: Writable buffer with room for struct.calcsize(STATE_FORMAT) bytes
+        :param wake_time: Time on the clock at which the board is due to wake
+        :param offset: Index of the state within memory
+        """
+        values = [STATE_MAGIC, self.readings.valid]
+        values.extend(self.readings.values)
+        for timestamp in self.readings.timestamps:
+            values.append(timestamp - wake_time)
+        for name in SENSOR_NAMES:
+            values.append(self._next_sample.get(name, wake_time) - wake_time)
+        values.append(self.last_update_time - wake_time)
+        values.append(self.last_calibration_time - wake_time)
+        values.append(self._notified_mask)
+        values.extend(self._notified)
+        for notified_time in self._notified_time:
+            values.append(notified_time - wake_time)
+        data = struct.pack(STATE_FORMAT, *values)
+        memory[offset:offset + len(data)] = data
+        end = offset + len(data)
+        if self.statistics is not None:
+            end += self.statistics.save(memory, end, wake_time)
+        if self.history is not None:
+            end += self.history.save(memory, end, wake_time)
+        elif len(memory) >= end + 2:
+            # No history samples
+            memory[end:end + 2] = bytes(2)
+            end += 2
+        if self.downsampler is not None:
+            self.downsampler.save(memory, end, wake_time)
+
+    def restore_state(self, memory, offset=0):
+        """Restore the readings and schedule saved with `save_state` after waking from deep sleep.
+        Only readings that were valid are restored, and they don't count as refreshed by the
+        next update. Returns False if memory holds no saved state.
+        :param memory: Buffer the state was saved to
+        :param offset: Index of the state within memory
+        """
+        size = struct.calcsize(STATE_FORMAT)
+        values = struct.unpack(STATE_FORMAT, bytes(memory[offset:offset + size]))
+        if values[0] != STATE_MAGIC:
+            return False
+        now = self.clock()
+        readings = self.readings
+        fields = len(SensorData.FIELDS)
+        readings.valid = values[1]
+        index = 2
+        for x in range(fields):
+            if readings.valid & (1 << x):
+                readings.values[x] = values[index]
+                readings.timestamps[x] = now + values[index + fields]
+            index += 1
+        index += fields
+        for name in SENSOR_NAMES:
+            if name in self._next_sample:
+                self._next_sample[name] = now + values[index]
+            index += 1
+        self.last_update_time = now + values[index]
+        self.last_calibration_time = now + values[index + 1]
+        index += 2
+        self._notified_mask = values[index]
+        index += 1
+        for x in range(fields):
+            self._notified[x] = values[index + x]
+            self._notified_time[x] = now + values[index + fields + x]
+        self.current_time = now
+        end = offset + size
+        if self.statistics is not None:
+            end += self.statistics.restore(memory, end, now)
+        if self.history is not None:
+            end += self.history.restore(memory, end, now)
+        elif len(memory) >= end + 2:
+            end += 2
+        if self.downsampler is not None:
+            self.downsampler.restore(memory, end, now)
+        return True
+
     def on_update(self, func):
         self.add_on_update(func)
         return func
@@ -140,38 +455,10 @@ class Sensors:
     def _update_values(self):
         if self.state == UPDATED:
             self.state = WAITING
-            
-            self.readings = SensorData()
 
         elif self.state == READING:
-            self.readings.temperature = self.bme280.temperature
-            self.readings.humidity = self.bme280.humidity
-            self.readings.pressure = self.bme280.pressure
-            self.readings.altitiude = self.bme280.altitude
-            
-            if self.pms5003:
-                try:
-                    data = self.pms5003.read()
-                    self.readings.pm1 = data["pm10 env"]
-                    self.readings.pm2_5 = data["pm25 env"]
-                    self.readings.pm10 = data["pm100 env"]
-                except RuntimeError as err:
-                    self.logger.error("{0}".format(err))
-            
-            if self.sgp30:
-                self.readings.eco2 = self.sgp30.eCO2
-                self.readings.tvoc = self.sgp30.TVOC
-            
-            self.ltr559.update_sensor()
-            self.readings.light = self.ltr559.get_lux()
-
-            battery_voltage = (
-                self.battery.value
-                / 2 ** 16
-                * self.divider_ratio
-                * self.battery.reference_voltage  # pylint: disable=no-member
-            )
-            self.readings.battery_voltage = int(battery_voltage * 1000)
+            self._sample_due()
+            self._publish()
 
             if self.debug:
                 print(self.readings)
@@ -180,15 +467,11 @@ class Sensors:
             self.state = UPDATED
 
         elif self.state == CALIBRATING:
-            if self.sgp30:
-                print(
-                    "**** Baseline values: eCO2 = 0x%x, TVOC = 0x%x"
-                    % (sgp30.baseline_eCO2, sgp30.baseline_TVOC)
-                )
-            self.last_calibration_time = self.current_time
+            self._calibrate()
             self.state = WAITING
 
         elif self.state == WAITING:
+            self._sample_due()
             update_elapsed = self.current_time - self.last_update_time
             calibrate_elapsed = self.current_time - self.last_calibration_time
             if update_elapsed > self.update_timeout:
@@ -196,12 +479,92 @@ class Sensors:
             elif calibrate_elapsed > self.calibration_timeout:
                 self.state = CALIBRATING
 
+    def _publish(self):
+        self.readings.publish()
+        if self.history is not None:
+            self.history.append(self.readings, self.current_time)
+        if self.statistics is not None:
+            self.statistics.update(self.readings, self.current_time)
+        if self.downsampler is not None:
+            self.downsampler.add(self.readings, self.current_time)
+        self.readings.changed = self._changed_fields()
+
+    def _changed_fields(self):
+        """Work out which fields moved outside their deadband since they were last passed on."""
+        readings = self.readings
+        changed = 0
+        for index, deadband in enumerate(self._deadbands):
+            bit = 1 << index
+            if not readings.valid & bit:
+                continue
+            if deadband is None:
+                if readings.refreshed & bit:
+                    changed |= bit
+                continue
+            value = readings.values[index]
+            last = self._notified[index]
+            silent = self.current_time - self._notified_time[index]
+            if not self._notified_mask & bit or \
+                    abs(value - last) > max(deadband.absolute, deadband.relative * abs(last)) or \
+                    (deadband.heartbeat is not None and silent >= deadband.heartbeat):
+                changed |= bit
+                self._notified[index] = value
+                self._notified_time[index] = self.current_time
+                self._notified_mask |= bit
+        return changed
+
+    def _read_bme280(self):
+        self.readings.temperature = self.bme280.temperature
+        self.readings.humidity = self.bme280.humidity
+        self.readings.pressure = self.bme280.pressure
+        self.readings.altitiude = self.bme280.altitude
+
+    def _read_pms5003(self):
+        if self._pms5003_scheduled:
+            data = self.pms5003.update()
+            due = self.pms5003.next_update
+            if due > self.current_time:
+                # Asleep or spinning up, nothing to poll until the scheduler's next step
+                self._next_sample['pms5003'] = due
+        else:
+            data = self.pms5003.poll()
+        if data is None:
+            return
+        self.readings.pm1 = data.pm_ug_per_m3(1.0)
+        self.readings.pm2_5 = data.pm_ug_per_m3(2.5)
+        self.readings.pm10 = data.pm_ug_per_m3(10)
+
+    def _read_sgp30(self):
+        self.readings.eco2 = self.sgp30.eCO2
+        self.readings.tvoc = self.sgp30.TVOC
+
+    def _read_ltr559(self):
+        self.ltr559.update_sensor()
+        self.readings.light = self.ltr559.get_lux(passive=True)
+
+    def _read_battery(self):
+        battery_voltage = (
+            self.battery.value
+            / 2 ** 16
+            * self.divider_ratio
+            * self.battery.reference_voltage  # pylint: disable=no-member
+        )
+        self.readings.battery_voltage = int(battery_voltage * 1000)
+
+    def _calibrate(self):
+        if self.sgp30:
+            print(
+                "**** Baseline values: eCO2 = 0x%x, TVOC = 0x%x"
+                % (self.sgp30.baseline_eCO2, self.sgp30.baseline_TVOC)
+            )
+        self.last_calibration_time = self.current_time
+
     def _notify_callbacks(self):
         state_changed = self.prev_state != self.state
         self.prev_state = self.state
         if not state_changed:
             return
 
-        if self.state == UPDATED:
+        if self.state == UPDATED and self.readings.changed:
             for on_update_callback in self._on_update_callbacks:
                 on_update_callback(self.readings)